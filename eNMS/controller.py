@@ -1,5 +1,8 @@
+from bisect import bisect, insort
 from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import redirect_stdout
+from csv import reader as csv_reader, writer as csv_writer
 from datetime import datetime
 from difflib import unified_diff
 from dramatiq import actor
@@ -8,8 +11,10 @@ from functools import wraps
 from git import Repo
 from io import BytesIO, StringIO
 from ipaddress import IPv4Network
-from json import dump, load
+from json import dump, dumps, load
 from logging import info
+from math import ceil
+from multiprocessing import get_context
 from operator import attrgetter, itemgetter
 from os import getenv, listdir, makedirs, scandir
 from os.path import exists
@@ -18,19 +23,26 @@ from re import search, sub
 from requests import get as http_get
 from ruamel import yaml
 from shutil import rmtree
-from sqlalchemy import and_, cast, or_, String
+from sqlalchemy import and_, cast, func, or_, String
 from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import aliased
 from sqlalchemy.sql.expression import true
 from subprocess import Popen
 from tarfile import open as open_tar
 from threading import current_thread, Thread
+from time import monotonic
 from traceback import format_exc
 from uuid import uuid4
+from warnings import warn
 from xlrd import open_workbook
 from xlrd.biffh import XLRDError
 from xlwt import Workbook
 
+try:
+    from openpyxl import load_workbook, Workbook as XlsxWorkbook
+except ImportError as exc:
+    warn(f"Couldn't import openpyxl module ({exc})")
+
 from eNMS.database import db
 from eNMS.forms import form_factory
 from eNMS.environment import env
@@ -247,21 +259,32 @@ class Controller:
         }
 
     def count_models(self):
-        active_service, active_workflow = 0, 0
-        for run in db.fetch_all("run", rbac=None, status="Running"):
-            active_service += 1
-            active_workflow += run.service.type == "workflow"
-        return {
-            "counters": {
+        run, service = vs.models["run"], vs.models["service"]
+        active_runs = dict(
+            db.session.query(service.type, func.count(run.id))
+            .join(service, run.service)
+            .filter(run.status == "Running")
+            .group_by(service.type)
+            .all()
+        )
+        if self.update_counters():
+            totals, models = env.get_counters("total"), vs.properties["dashboard"]
+            counters = {model: totals.get(model, 0) for model in models}
+            active_tasks = env.get_counters("task/is_active").get("True", 0)
+        else:
+            counters = {
                 model: db.query(model, rbac=None)
                 .with_entities(vs.models[model].id)
                 .count()
                 for model in vs.properties["dashboard"]
-            },
+            }
+            active_tasks = len(db.fetch_all("task", rbac=None, is_active=True))
+        return {
+            "counters": counters,
             "active": {
-                "service": active_service,
-                "task": len(db.fetch_all("task", rbac=None, is_active=True)),
-                "workflow": active_workflow,
+                "service": sum(active_runs.values()),
+                "task": active_tasks,
+                "workflow": active_runs.get("workflow", 0),
             },
             "properties": {
                 model: self.counters(vs.properties["dashboard"][model][0], model)
@@ -270,6 +293,8 @@ class Controller:
         }
 
     def counters(self, property, model):
+        if property in db.counted_properties.get(model, ()) and self.update_counters():
+            return env.get_counters(f"{model}/{property}")
         return Counter(v for v, in db.query(model, properties=[property], rbac=None))
 
     def create_label(self, type, id, x, y, label_id, **kwargs):
@@ -419,50 +444,118 @@ class Controller:
             ).filter(intersect_table.id == constraint_dict["intersect"]["id"])
         return query
 
+    def filtering_query(self, query, model, **kwargs):
+        constraints = self.filtering_base_constraints(model, **kwargs)
+        constraints.extend(vs.models[model].filtering_constraints(**kwargs))
+        query = self.filtering_relationship_constraints(query, model, **kwargs)
+        return query.filter(and_(*constraints))
+
+    def get_table_cache(self, cache, key, default=None):
+        timestamp, value = vs.table_cache[cache].get(key, (None, default))
+        cache_time = vs.settings["tables"]["cache_time"]
+        if timestamp and (datetime.now() - timestamp).total_seconds() < cache_time:
+            return value
+        return default
+
+    def set_table_cache(self, cache, key, value):
+        if len(vs.table_cache[cache]) > vs.settings["tables"]["cache_size"]:
+            vs.table_cache[cache].clear()
+        vs.table_cache[cache][key] = (datetime.now(), value)
+
+    def get_table_count(self, key, query, model):
+        count = self.get_table_cache("count", key)
+        if count is None:
+            count = query.with_entities(vs.models[model].id).count()
+            self.set_table_cache("count", key, count)
+        return count
+
     def filtering(
         self, model, bulk=False, rbac="read", username=None, properties=None, **kwargs
     ):
         table, pagination = vs.models[model], kwargs.get("pagination")
         query = db.query(model, rbac, username, properties=properties)
         total_records, filtered_records = (10**6,) * 2
+        user_key = (model, rbac, username or getattr(current_user, "name", None))
         if pagination and not bulk and not properties:
-            total_records = query.with_entities(table.id).count()
-        constraints = self.filtering_base_constraints(model, **kwargs)
-        constraints.extend(table.filtering_constraints(**kwargs))
-        query = self.filtering_relationship_constraints(query, model, **kwargs)
-        query = query.filter(and_(*constraints))
+            total_records = self.get_table_count(user_key, query, model)
+        query = self.filtering_query(query, model, **kwargs)
         if bulk or properties:
             instances = query.all()
             if bulk == "object" or properties:
                 return instances
             else:
                 return [getattr(instance, bulk) for instance in instances]
+        filtering_kwargs = {
+            key: value
+            for key, value in kwargs.items()
+            if key not in ("clipboard", "draw", "length", "start")
+        }
+        table_key = (*user_key, dumps(filtering_kwargs, sort_keys=True, default=str))
         if pagination:
-            filtered_records = query.with_entities(table.id).count()
+            filtered_records = self.get_table_count(table_key, query, model)
         data = kwargs["columns"][int(kwargs["order"][0]["column"])]["data"]
-        ordering = getattr(getattr(table, data, None), kwargs["order"][0]["dir"], None)
+        direction, column = kwargs["order"][0]["dir"], getattr(table, data, None)
+        ordering = getattr(column, direction, None)
+        start, length = int(kwargs["start"]), int(kwargs["length"])
+        boundary = None
         if ordering:
-            query = query.order_by(ordering())
-        try:
-            query_data = (
-                query.limit(int(kwargs["length"])).offset(int(kwargs["start"])).all()
+            query = query.order_by(ordering(), getattr(table.id, direction)())
+            boundary = self.get_table_cache("boundary", (table_key, start))
+        if boundary:
+            value, last_id = boundary
+            operator = "__gt__" if direction == "asc" else "__lt__"
+            constraint = or_(
+                getattr(column, operator)(value),
+                and_(column == value, getattr(table.id, operator)(last_id)),
             )
+            if (direction == "asc") == (db.dialect == "postgresql"):
+                constraint = or_(constraint, column.is_(None))
+            page_query = query.filter(constraint).limit(length)
+        else:
+            page_query = query.limit(length).offset(start)
+        try:
+            query_data = page_query.all()
         except OperationalError:
             return {"error": "Invalid regular expression as search parameter."}
+        if ordering and query_data and len(query_data) == length:
+            value = getattr(query_data[-1], data)
+            if value is not None:
+                boundary = (value, query_data[-1].id)
+                self.set_table_cache("boundary", (table_key, start + length), boundary)
         table_result = {
             "draw": int(kwargs["draw"]),
             "recordsTotal": total_records,
             "recordsFiltered": filtered_records,
             "data": [obj.table_properties(**kwargs) for obj in query_data],
         }
-        if kwargs.get("export"):
-            table_result["full_result"] = [
-                obj.table_properties(**kwargs) for obj in query.all()
-            ]
         if kwargs.get("clipboard"):
-            table_result["full_result"] = ",".join(obj.name for obj in query.all())
+            names = query.with_entities(table.name).all()
+            table_result["full_result"] = ",".join(name for name, in names)
         return table_result
 
+    def export_table(self, model, export_columns, rbac="read", **kwargs):
+        table, chunk_size = vs.models[model], vs.settings["tables"]["export_chunk_size"]
+        query = self.filtering_query(db.query(model, rbac), model, **kwargs)
+        query = query.order_by(table.id)
+        instances = query.limit(chunk_size).all()
+
+        def stream(instances):
+            output = StringIO()
+            writer = csv_writer(output)
+            writer.writerow(export_columns)
+            while instances:
+                for instance in instances:
+                    properties = instance.table_properties(**kwargs)
+                    writer.writerow(map(properties.get, export_columns))
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
+                last_id = instances[-1].id
+                instances = query.filter(table.id > last_id).limit(chunk_size).all()
+            yield output.getvalue()
+
+        return stream(instances)
+
     def get(self, model, id, **kwargs):
         if not kwargs:
             get_model = (
@@ -538,19 +631,41 @@ class Controller:
 
     def get_git_history(self, device_id):
         device = db.fetch("device", id=device_id, rbac="configuration")
-        repo = Repo(vs.path / "network_data")
-        path = vs.path / "network_data" / device.name
-        return {
-            data_type: [
-                {"hash": str(commit), "date": commit.committed_datetime}
-                for commit in list(repo.iter_commits(paths=path / data_type))
-            ]
-            for data_type in vs.configuration_properties
-        }
+        model = vs.models["configuration_version"]
+        history = {property: [] for property in vs.configuration_properties}
+        if vs.settings["configuration_store"]["active"]:
+            for version in (
+                db.session.query(model)
+                .filter_by(device_id=device.id)
+                .order_by(model.timestamp.desc(), model.id.desc())
+            ):
+                history[version.property].append(
+                    {"hash": version.hash, "date": version.timestamp}
+                )
+        path = vs.path / "network_data"
+        if not exists(path / ".git"):
+            return history
+        repo = Repo(path)
+        for property, versions in history.items():
+            oldest_version = versions[-1]["date"] if versions else None
+            for commit in repo.iter_commits(paths=path / device.name / property):
+                date = str(datetime.fromtimestamp(commit.committed_date))
+                if not oldest_version or date < oldest_version:
+                    versions.append({"hash": str(commit), "date": date})
+        return history
 
     def get_git_network_data(self, device_name, hash):
-        commit, result = Repo(vs.path / "network_data").commit(hash), {}
         device = db.fetch("device", name=device_name, rbac="configuration")
+        model = vs.models["configuration_version"]
+        versions = db.session.query(model).filter_by(device_id=device.id, hash=hash)
+        if versions.first():
+            result = dict.fromkeys(vs.configuration_properties, "")
+            for version in versions:
+                result[version.property] = vs.custom.parse_configuration_property(
+                    device, version.property, model.get_content(hash)
+                )
+            return {"result": result, "datetime": version.timestamp}
+        commit, result = Repo(vs.path / "network_data").commit(hash), {}
         for property in vs.configuration_properties:
             try:
                 file = commit.tree / device_name / property
@@ -587,6 +702,44 @@ class Controller:
     def get_result(self, id):
         return db.fetch("result", id=id).result
 
+    def get_result_metrics(self, group_by="service", **kwargs):
+        if group_by not in ("device", "service", "workflow"):
+            return {"alert": f"Cannot group result metrics by '{group_by}'."}
+        metric, statistics = vs.models["result_metric"], defaultdict(list)
+        query = db.query("result_metric")
+        rows = self.filtering_query(query, "result_metric", **kwargs).with_entities(
+            getattr(metric, f"{group_by}_id"), metric.success, metric.duration
+        )
+        for id, success, duration in rows.yield_per(db.transactions["bulk_chunk_size"]):
+            statistics[id].append((success, duration))
+        table = vs.models["service" if group_by == "workflow" else group_by]
+        ids = [id for id in statistics if id is not None]
+        names = dict(db.session.query(table.id, table.name).filter(table.id.in_(ids)))
+        metrics = []
+        for id, results in statistics.items():
+            durations = sorted(time for _, time in results if time is not None)
+            failures = sum(not success for success, _ in results)
+            group = {
+                "id": id,
+                "name": names.get(id),
+                "results": len(results),
+                "failures": failures,
+                "success_rate": round(1 - failures / len(results), 4),
+            }
+            if durations:
+                group.update(
+                    {
+                        "average_duration": round(sum(durations) / len(durations), 3),
+                        "p95_duration": durations[ceil(len(durations) * 0.95) - 1],
+                        "max_duration": durations[-1],
+                    }
+                )
+            metrics.append(group)
+        return sorted(metrics, key=itemgetter("failures"), reverse=True)
+
+    def get_run_registry(self):
+        return vs.run_registry.get_memory_usage()
+
     def get_runtimes(self, id, display=None):
         service_alias = aliased(vs.models["service"])
         query = (
@@ -602,21 +755,17 @@ class Controller:
         log_instance = db.fetch(
             "service_log", allow_none=True, runtime=runtime, service_id=service
         )
-        number_of_lines = 0
+        device_name = db.fetch("device", id=device).name if device else None
         if log_instance:
             lines = log_instance.content.splitlines()
+            if device:
+                lines = [line for line in lines if f"DEVICE {device_name}" in line]
         else:
-            lines = (
-                env.log_queue(runtime, service, start_line=int(line), mode="get") or []
-            )
-            number_of_lines = len(lines)
-        if device:
-            device_name = db.fetch("device", id=device).name
-            lines = [line for line in lines if f"DEVICE {device_name}" in line]
+            lines, line = env.log_stream(runtime, service, line, device_name)
         return {
-            "logs": "\n".join(lines),
+            "logs": "\n".join(lines or []),
             "refresh": not log_instance,
-            "line": int(line) + number_of_lines,
+            "line": line,
         }
 
     def get_service_state(self, path, **kwargs):
@@ -637,7 +786,7 @@ class Controller:
                 run = sorted(runs, key=attrgetter("runtime"), reverse=True)[0]
             else:
                 run = db.fetch("run", allow_none=True, runtime=runtime)
-            state = run.get_state() if run else None
+            state = run.get_state(path) if run else None
         if kwargs.get("device") and run:
             output["device_state"] = {
                 result.service_id: result.success
@@ -733,7 +882,7 @@ class Controller:
     def get_workflow_results(self, path, runtime):
         run = db.fetch("run", runtime=runtime)
         service = db.fetch("service", id=path.split(">")[-1])
-        state = run.state
+        state = run.get_state()
 
         def rec(service, path):
             if path not in state:
@@ -766,6 +915,48 @@ class Controller:
 
         return rec(service, path)
 
+    def get_topology_rows(self, model):
+        properties = [
+            property
+            for property in vs.model_properties[model]
+            if property not in db.dont_migrate[model]
+            and hasattr(vs.models[model], property)
+        ]
+        yield properties
+        query = db.query(model, properties=properties)
+        for row in query.yield_per(vs.settings["tables"]["export_chunk_size"]):
+            yield [
+                (
+                    str(env.decrypt(value), "utf-8")
+                    if isinstance(value, bytes)
+                    else str(value)
+                )
+                for value in row
+            ]
+
+    def get_topology_sheets(self, file):
+        path = Path(file.filename)
+        if path.suffix == ".csv":
+            model = "link" if path.stem.endswith("link") else "device"
+            rows = csv_reader(StringIO(file.read().decode("utf-8")))
+            yield model, next(rows, []), rows
+        elif path.suffix == ".xlsx":
+            workbook = load_workbook(BytesIO(file.read()), read_only=True)
+            for model in ("device", "link"):
+                if model not in workbook.sheetnames:
+                    continue
+                rows = workbook[model].iter_rows(values_only=True)
+                yield model, next(rows, ()), rows
+        else:
+            book = open_workbook(file_contents=file.read())
+            for model in ("device", "link"):
+                try:
+                    sheet = book.sheet_by_name(model)
+                except XLRDError:
+                    continue
+                rows = (sheet.row_values(index) for index in range(sheet.nrows))
+                yield model, next(rows, []), rows
+
     def get_workflow_services(self, id, node):
         parents = db.fetch("workflow", id=id).get_ancestors()
         if node == "all":
@@ -940,6 +1131,11 @@ class Controller:
                 file,
             )
 
+    @staticmethod
+    def load_migration_file(path):
+        with open(path, "r") as migration_file:
+            return yaml.load(migration_file, Loader=yaml.CLoader)
+
     def migration_import(self, folder="migrations", **kwargs):
         env.log("info", "Starting Migration Import")
         env.log_events = False
@@ -968,16 +1164,36 @@ class Controller:
             if service:
                 store["swiss_army_knife_service"][service.name] = service
                 store["service"][service.name] = service
+        bulk_models = set(vs.settings["migration"]["bulk_models"])
+        if service_import or env.use_vault:
+            bulk_models = set()
+        bulk_instances, futures = defaultdict(set), {}
+        processes = vs.settings["migration"]["parsing_processes"]
+        executor = None
+        if processes:
+            executor = ProcessPoolExecutor(processes, mp_context=get_context("spawn"))
+        for model in models:
+            path = folder_path / f"{model}.yaml"
+            if executor and path.exists():
+                futures[model] = executor.submit(
+                    yaml.load, path.read_text(), Loader=yaml.CLoader
+                )
         for model in models:
             path = folder_path / f"{model}.yaml"
             if not path.exists():
                 if service_import and model == "service":
                     raise Exception("Invalid archive provided in service import.")
                 continue
-            with open(path, "r") as migration_file:
-                instances = yaml.load(migration_file, Loader=yaml.CLoader)
+            if model in futures:
+                instances = futures[model].result()
+            else:
+                instances = self.load_migration_file(path)
             before_time = datetime.now()
             env.log("info", f"Creating {model}s")
+            existing_names, mappings = set(), defaultdict(list)
+            bulk_import = model in bulk_models
+            if bulk_import and not empty_database:
+                existing_names = set(db.get_name_map(model))
             for instance in instances:
                 type, relation_dict = instance.pop("type", model), {}
                 for related_model, relation in vs.relationships[type].items():
@@ -990,6 +1206,14 @@ class Controller:
                 try:
                     if instance["name"] in store[model]:
                         instance = store[model][instance["name"]]
+                    elif bulk_import and instance["name"] not in existing_names:
+                        for property, value in instance_private_properties.items():
+                            if value:
+                                password = env.encrypt_password(value)
+                                instance[property] = password.decode("utf-8")
+                        mappings[type].append(instance)
+                        relations[type][instance["name"]] = relation_dict
+                        continue
                     else:
                         instance = db.factory(
                             type,
@@ -1014,45 +1238,59 @@ class Controller:
                         db.session.rollback()
                         return "Error during import; service was not imported."
                     status = {"alert": "partial import (see logs)."}
+            for type, type_mappings in mappings.items():
+                bulk_instances[type].update(db.bulk_insert(type, type_mappings))
             db.session.commit()
             total_time = datetime.now() - before_time
             env.log("info", f"{model.capitalize()}s created in {total_time}")
-        for model, instances in relations.items():
-            env.log("info", f"Setting up {model}s database relationships")
-            before_time = datetime.now()
-            for instance_name, related_models in instances.items():
-                for property, value in related_models.items():
-                    if not value:
-                        continue
-                    relation = vs.relationships[model][property]
-                    if relation["list"]:
-                        sql_value = []
-                        for name in value:
-                            if name not in store[relation["model"]]:
+        if executor:
+            executor.shutdown()
+        if service_import:
+            for model, instances in relations.items():
+                env.log("info", f"Setting up {model}s database relationships")
+                before_time = datetime.now()
+                for instance_name, related_models in instances.items():
+                    for property, value in related_models.items():
+                        if not value:
+                            continue
+                        relation = vs.relationships[model][property]
+                        related_store = store[relation["model"]]
+                        if relation["list"]:
+                            sql_value = []
+                            for name in value:
+                                if name not in related_store:
+                                    related_instance = db.fetch(
+                                        relation["model"], name=name, allow_none=True
+                                    )
+                                    if related_instance:
+                                        related_store[name] = related_instance
+                                if name in related_store:
+                                    sql_value.append(related_store[name])
+                        else:
+                            if value not in related_store:
                                 related_instance = db.fetch(
-                                    relation["model"], name=name, allow_none=True
+                                    relation["model"], name=value, allow_none=True
                                 )
                                 if related_instance:
-                                    store[relation["model"]][name] = related_instance
-                            if name in store[relation["model"]]:
-                                sql_value.append(store[relation["model"]][name])
-                    else:
-                        if value not in store[relation["model"]]:
-                            related_instance = db.fetch(
-                                relation["model"], name=value, allow_none=True
-                            )
-                            if related_instance:
-                                store[relation["model"]][value] = related_instance
-                        sql_value = store[relation["model"]][value]
-                    try:
-                        setattr(store[model].get(instance_name), property, sql_value)
-                    except Exception:
-                        info("\n".join(format_exc().splitlines()))
-                        if service_import:
+                                    related_store[value] = related_instance
+                            sql_value = related_store[value]
+                        try:
+                            instance = store[model].get(instance_name)
+                            setattr(instance, property, sql_value)
+                        except Exception:
+                            info("\n".join(format_exc().splitlines()))
                             db.session.rollback()
                             return "Error during import; service was not imported."
-                        status = {"alert": "Partial Import (see logs)."}
-            env.log("info", f"Relationships created in {datetime.now() - before_time}")
+                relations_time = datetime.now() - before_time
+                env.log("info", f"Relationships created in {relations_time}")
+        else:
+            try:
+                if not self.migration_relations(relations, bulk_instances):
+                    status = {"alert": "Partial Import (see logs)."}
+            except Exception:
+                info(f"Relationships could not be imported:\n{format_exc()}")
+                db.session.rollback()
+                status = {"alert": "Partial Import (see logs)."}
         db.session.commit()
         if service_import:
             service = store["service"][metadata["service"]]
@@ -1068,14 +1306,55 @@ class Controller:
         if not kwargs.get("skip_pool_update"):
             before_time = datetime.now()
             env.log("info", "Starting pool update")
-            for pool in store["pool"].values():
-                pool.compute_pool()
+            vs.models["pool"].compute_pools(list(store["pool"].values()))
             env.log("info", f"Pool update done ({datetime.now() - before_time}s)")
         db.session.commit()
         env.log_events = True
         env.log("info", f"{status} (execution time: {datetime.now() - start_time}s)")
         return status
 
+    def migration_relations(self, relations, bulk_instances):
+        env.log("info", "Setting up database relationships")
+        before_time, bulk_relations = datetime.now(), defaultdict(dict)
+        related_models = {model for model in relations} | {
+            vs.relationships[model][property]["model"]
+            for model, instances in relations.items()
+            for related_instances in instances.values()
+            for property, value in related_instances.items()
+            if value
+        }
+        name_maps = {model: db.get_name_map(model) for model in related_models}
+        for model, instances in relations.items():
+            default_rbac = db.get_default_rbac(model)
+            for instance_name, related_instances in instances.items():
+                instance_id = name_maps[model].get(instance_name)
+                if not instance_id:
+                    continue
+                for property, value in related_instances.items():
+                    if not value:
+                        if instance_name in bulk_instances[model]:
+                            if property in default_rbac:
+                                ids = list(default_rbac[property])
+                                bulk_relations[(model, property)][instance_id] = ids
+                        continue
+                    relation = vs.relationships[model][property]
+                    name_map = name_maps[relation["model"]]
+                    bulk_relations[(model, property)][instance_id] = [
+                        name_map[name]
+                        for name in (value if relation["list"] else [value])
+                        if name in name_map
+                    ]
+        success = True
+        for (model, property), values in bulk_relations.items():
+            try:
+                with db.session.begin_nested():
+                    db.bulk_relate({(model, property): values})
+            except Exception:
+                info(f"{model} {property} could not be imported:\n{format_exc()}")
+                success = False
+        env.log("info", f"Relationships created in {datetime.now() - before_time}")
+        return success
+
     def multiselect_filtering(self, model, **params):
         table = vs.models[model]
         query = db.query(model).filter(table.name.contains(params.get("term")))
@@ -1096,6 +1375,35 @@ class Controller:
             "total_count": query.count(),
         }
 
+    def import_configuration_history(self):
+        model, path = vs.models["configuration_version"], vs.path / "network_data"
+        repo = Repo(path)
+        for device in db.fetch_all("device"):
+            for property in vs.configuration_properties:
+                versions = sorted(
+                    db.session.query(model.timestamp, model.hash).filter_by(
+                        device_id=device.id, property=property
+                    )
+                )
+                commits = repo.iter_commits(paths=path / device.name / property)
+                for commit in reversed(list(commits)):
+                    try:
+                        file = commit.tree / device.name / property
+                    except KeyError:
+                        continue
+                    value = file.data_stream.read().decode("utf-8")
+                    version = (
+                        str(datetime.fromtimestamp(commit.committed_date)),
+                        model.get_hash(value),
+                    )
+                    position = bisect(versions, version)
+                    if position and versions[position - 1][1] == version[1]:
+                        continue
+                    model.store(device, property, value, version[0], deduplicate=False)
+                    insort(versions, version)
+            db.session.commit()
+        env.log("info", "Configuration history imported from Git")
+
     def import_services(self, **kwargs):
         file = kwargs["file"]
         filepath = vs.file_path / "services" / file.filename
@@ -1164,6 +1472,8 @@ class Controller:
             )
             session_query.delete(synchronize_session=False)
             db.session.commit()
+        if vs.settings["blob_store"]["active"]:
+            db.delete_orphan_blobs()
 
     @staticmethod
     @actor(max_retries=0, time_limit=float("inf"))
@@ -1375,48 +1685,111 @@ class Controller:
         return db.fetch("task", id=task_id, rbac="edit").schedule(mode)
 
     def topology_export(self, **kwargs):
-        workbook = Workbook()
         filename = kwargs["export_filename"]
         if "." not in filename:
-            filename += ".xls"
-        for obj_type in ("device", "link"):
-            sheet = workbook.add_sheet(obj_type)
-            for index, property in enumerate(vs.model_properties[obj_type]):
-                if property in db.dont_migrate[obj_type]:
-                    continue
-                sheet.write(0, index, property)
-                for obj_index, obj in enumerate(db.fetch_all(obj_type), 1):
-                    value = getattr(obj, property)
-                    if type(value) == bytes:
-                        value = str(env.decrypt(value), "utf-8")
-                    sheet.write(obj_index, index, str(value))
-        workbook.save(vs.file_path / "spreadsheets" / filename)
+            filename += f".{kwargs.get('export_format', 'xls')}"
+        path = vs.file_path / "spreadsheets" / filename
+        if path.suffix == ".csv":
+            for model in ("device", "link"):
+                csv_path = path.with_name(f"{path.stem}_{model}.csv")
+                with open(csv_path, "w", newline="") as file:
+                    csv_writer(file).writerows(self.get_topology_rows(model))
+        elif path.suffix == ".xlsx":
+            workbook = XlsxWorkbook(write_only=True)
+            for model in ("device", "link"):
+                sheet = workbook.create_sheet(model)
+                for row in self.get_topology_rows(model):
+                    sheet.append(row)
+            workbook.save(path)
+        else:
+            workbook = Workbook()
+            for model in ("device", "link"):
+                sheet = workbook.add_sheet(model)
+                for row_index, row in enumerate(self.get_topology_rows(model)):
+                    for index, value in enumerate(row):
+                        sheet.write(row_index, index, value)
+            workbook.save(path)
 
     def topology_import(self, file):
-        book = open_workbook(file_contents=file.read())
         status = "Topology successfully imported."
-        for obj_type in ("device", "link"):
-            try:
-                sheet = book.sheet_by_name(obj_type)
-            except XLRDError:
-                continue
-            properties = sheet.row_values(0)
-            for row_index in range(1, sheet.nrows):
-                values = {}
-                for index, property in enumerate(properties):
-                    if not property:
-                        continue
-                    property_type = vs.model_properties[obj_type].get(property, "str")
-                    func = db.field_conversion[property_type]
-                    values[property] = func(sheet.row_values(row_index)[index])
+        forbidden_characters = set("/\\'" + '"')
+        for model, properties, rows in self.get_topology_sheets(file):
+            instances = {}
+            for row in rows:
                 try:
-                    db.factory(obj_type, **values).serialized
+                    values = {}
+                    for property, value in zip(properties, row):
+                        if not property or value is None:
+                            continue
+                        property_type = vs.model_properties[model].get(property, "str")
+                        values[property] = db.field_conversion[property_type](value)
+                    if forbidden_characters & set(values["name"]):
+                        raise Exception("Names cannot contain a slash or a quote.")
+                    instances[values["name"]] = {
+                        **values,
+                        "last_modified": vs.get_time(),
+                        "last_modified_by": getattr(current_user, "name", "admin"),
+                    }
                 except Exception as exc:
-                    info(f"{str(values)} could not be imported ({str(exc)})")
+                    info(f"{str(row)} could not be imported ({str(exc)})")
                     status = "Partial import (see logs)."
+            name_map, table = db.get_name_map(model), vs.models[model]
+            editable_ids = {id for id, in db.query(model, "edit", properties=["id"])}
+            for name in [name for name in instances if name in name_map]:
+                if name_map[name] not in editable_ids:
+                    info(f"{name} could not be imported (not allowed to edit {model})")
+                    status = "Partial import (see logs)."
+                    instances.pop(name)
+            existing_instances = [
+                instance for name, instance in instances.items() if name in name_map
+            ]
+            if model in vs.rbac["rbac_models"] and not getattr(
+                current_user, "is_admin", True
+            ):
+                owned_ids = {
+                    id
+                    for id, in db.session.query(table.id).filter(
+                        table.owners.any(id=current_user.id)
+                    )
+                }
+                rbac_properties = ["owners", "restrict_to_owners"]
+                rbac_properties.extend(vs.rbac["rbac_models"][model])
+                for instance in existing_instances:
+                    if name_map[instance["name"]] in owned_ids:
+                        continue
+                    for property in rbac_properties:
+                        instance.pop(property, None)
+            db.bulk_update(model, existing_instances, name_map)
+            new_instances = [
+                instance for name, instance in instances.items() if name not in name_map
+            ]
+            created_instances = db.bulk_insert(model, new_instances)
+            name_map.update(created_instances)
+            relations = defaultdict(dict)
+            for property, ids in db.get_default_rbac(model).items():
+                relations[(model, property)] = dict.fromkeys(
+                    created_instances.values(), list(ids)
+                )
+            for property in properties:
+                attribute = getattr(vs.models[model], property or "", None)
+                if getattr(attribute, "value_attr", None) != "name":
+                    continue
+                relation = attribute.target_collection
+                related_model = vs.relationships[model][relation]["model"]
+                related_name_map = db.get_name_map(related_model)
+                for name, instance in instances.items():
+                    if property not in instance:
+                        continue
+                    if instance[property] not in related_name_map:
+                        info(f"{name}: no {related_model} '{instance[property]}'")
+                        status = "Partial import (see logs)."
+                        continue
+                    related_id = related_name_map[instance[property]]
+                    relations[(model, relation)][name_map[name]] = [related_id]
+            db.bulk_relate(relations)
             db.session.commit()
-        for pool in db.fetch_all("pool", rbac="edit"):
-            pool.compute_pool()
+        vs.models["pool"].compute_pools(db.fetch_all("pool", rbac="edit"))
+        db.session.commit()
         env.log("info", status)
         return status
 
@@ -1452,8 +1825,28 @@ class Controller:
             return {"alert": str(exc)}
 
     def update_all_pools(self):
-        for pool in db.fetch_all("pool", rbac="edit"):
-            pool.compute_pool()
+        vs.models["pool"].compute_pools(db.fetch_all("pool", rbac="edit"))
+
+    def update_counters(self):
+        settings, last_update = vs.settings["counters"], env.counters_reconciliation
+        if not settings["active"]:
+            return False
+        interval = settings["reconciliation_interval"]
+        if last_update and monotonic() - last_update < interval:
+            return True
+        counters = {"total": {}}
+        for model, properties in db.counted_properties.items():
+            table = vs.models[model]
+            query = db.query(model, rbac=None)
+            counters["total"][model] = query.with_entities(table.id).count()
+            for property in properties:
+                column = getattr(table, property)
+                values = query.with_entities(column, func.count(table.id))
+                counters[f"{model}/{property}"] = {
+                    str(value): count for value, count in values.group_by(column)
+                }
+        env.set_counters(counters)
+        return True
 
     def update_database_configurations_from_git(self, force_update=False):
         path = vs.path / "network_data"
@@ -1480,14 +1873,23 @@ class Controller:
                 if not filepath.exists() or no_update:
                     continue
                 with open(filepath) as file:
-                    setattr(device, property, file.read())
+                    value = file.read()
+                setattr(device, property, value)
+                vs.models["configuration_version"].store(
+                    device, property, value, getattr(device, f"last_{property}_update")
+                )
         db.session.commit()
-        for pool in db.fetch_all("pool"):
+        if vs.settings["pools"]["incremental_update"]:
+            return
+        pools = [
+            pool
+            for pool in db.fetch_all("pool")
             if any(
                 getattr(pool, f"device_{property}")
                 for property in vs.configuration_properties
-            ):
-                pool.compute_pool()
+            )
+        ]
+        vs.models["pool"].compute_pools(pools)
         db.session.commit()
 
     def update_device_rbac(self):
@@ -1,27 +1,36 @@
 from ast import literal_eval
 from atexit import register
+from collections import Counter, defaultdict
 from contextlib import contextmanager
 from flask_login import current_user
+from gzip import compress as gzip_compress, decompress as gzip_decompress
+from hashlib import sha256
 from importlib.util import module_from_spec, spec_from_file_location
 from json import loads
 from logging import error, info, warning
 from operator import attrgetter
-from os import getenv, getpid
+from os import getenv, getpid, replace
 from os.path import exists
 from pathlib import Path
+from pickle import dumps as pickle_dumps, loads as pickle_loads
 from sqlalchemy import (
+    bindparam,
     Boolean,
     Column,
     create_engine,
     event,
     ForeignKey,
     Float,
+    func,
     inspect,
     Integer,
+    LargeBinary,
     PickleType,
     String,
     Table,
     Text,
+    type_coerce,
+    TypeDecorator,
 )
 from sqlalchemy.dialects.mysql.base import MSMediumBlob
 from sqlalchemy.exc import InvalidRequestError, OperationalError
@@ -29,20 +38,88 @@ from sqlalchemy.ext.associationproxy import AssociationProxyExtensionType
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 from sqlalchemy.ext.mutable import MutableDict, MutableList
 from sqlalchemy.orm import (
+    aliased,
     configure_mappers,
+    MANYTOMANY,
+    MANYTOONE,
     relationship,
     scoped_session,
     sessionmaker,
 )
 from sqlalchemy.orm.collections import InstrumentedList
 from sqlalchemy.types import JSON
-from time import sleep
+from tempfile import NamedTemporaryFile
+from time import monotonic, sleep, time
 from traceback import format_exc
 from uuid import getnode
+from warnings import warn
+
+try:
+    from zstandard import ZstdCompressor, ZstdDecompressor
+except ImportError as exc:
+    warn(f"Couldn't import zstandard module ({exc})")
 
 from eNMS.variables import vs
 
 
+class BlobStore:
+    prefix = "eNMS-blob:"
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.path = Path(settings["path"] or vs.file_path / "blobs")
+
+    def compress(self, data, algorithm):
+        if algorithm == "zstd":
+            return ZstdCompressor().compress(data)
+        return gzip_compress(data)
+
+    def decompress(self, data, algorithm):
+        if algorithm == "zstd":
+            return ZstdDecompressor().decompress(data)
+        return gzip_decompress(data)
+
+    def delete_orphans(self, references):
+        deleted, now = 0, time()
+        for path in self.path.glob("*/*"):
+            digest, _, algorithm = path.name.partition(".")
+            if f"{self.prefix}{algorithm}:{digest}" in references:
+                continue
+            elif now - path.stat().st_mtime < self.settings["orphan_retention"]:
+                continue
+            path.unlink(missing_ok=True)
+            deleted += 1
+        return deleted
+
+    def get_path(self, reference):
+        algorithm, digest = reference[len(self.prefix) :].split(":")
+        return self.path / digest[:2] / f"{digest}.{algorithm}", algorithm
+
+    def read(self, reference):
+        path, algorithm = self.get_path(reference)
+        return self.decompress(path.read_bytes(), algorithm)
+
+    def write(self, data):
+        algorithm = self.settings["compression"]
+        if algorithm == "zstd" and "ZstdCompressor" not in globals():
+            algorithm = "gzip"
+        reference = f"{self.prefix}{algorithm}:{sha256(data).hexdigest()}"
+        path, _ = self.get_path(reference)
+        if path.exists():
+            path.touch()
+            return reference
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with NamedTemporaryFile(dir=path.parent, delete=False) as file:
+            file.write(self.compress(data, algorithm))
+        try:
+            replace(file.name, path)
+        except OSError:
+            Path(file.name).unlink(missing_ok=True)
+            if not path.exists():
+                raise
+        return reference
+
+
 class Database:
     def __init__(self):
         for setting in vs.database.items():
@@ -162,6 +239,38 @@ class Database:
             if self.dialect.startswith(("mariadb", "mysql")):
                 impl = MSMediumBlob
 
+        class BlobPickleType(CustomPickleType):
+            def bind_processor(self, dialect):
+                impl_processor = self.impl.bind_processor(dialect)
+
+                def process(value):
+                    if value is None:
+                        return
+                    value = pickle_dumps(value, self.protocol)
+                    reference = database.store_blob(value)
+                    value = reference.encode("utf-8") if reference else value
+                    return impl_processor(value) if impl_processor else value
+
+                return process
+
+            def result_processor(self, dialect, coltype):
+                impl_processor = self.impl.result_processor(dialect, coltype)
+
+                def process(value):
+                    if impl_processor:
+                        value = impl_processor(value)
+                    if value is None:
+                        return
+                    elif value.startswith(BlobStore.prefix.encode("utf-8")):
+                        value = database.blob_store.read(value.decode("utf-8"))
+                    return pickle_loads(value)
+
+                return process
+
+        database = self
+        self.Binary = LargeBinary()
+        for dialect in ("mariadb", "mysql"):
+            self.Binary = self.Binary.with_variant(MSMediumBlob(), dialect)
         self.Dict = MutableDict.as_mutable(CustomPickleType)
         self.List = MutableList.as_mutable(CustomPickleType)
         if self.dialect == "postgresql":
@@ -171,7 +280,30 @@ class Database:
         self.SmallString = String(self.columns["length"]["small_string"])
         self.TinyString = String(self.columns["length"]["tiny_string"])
 
+        class BlobText(TypeDecorator):
+            cache_ok = True
+            impl = self.LargeString
+
+            def process_bind_param(self, value, dialect):
+                if value is None:
+                    return
+                is_prefixed = value.startswith(BlobStore.prefix)
+                reference = database.store_blob(value.encode("utf-8"), is_prefixed)
+                return reference or value
+
+            def process_result_value(self, value, dialect):
+                if value and value.startswith(BlobStore.prefix):
+                    return database.blob_store.read(value).decode("utf-8")
+                return value
+
+        self.BlobDict = MutableDict.as_mutable(BlobPickleType)
+        self.BlobText = BlobText()
+        self.blob_types = (BlobPickleType, BlobText)
+        self.blob_store = BlobStore(vs.settings["blob_store"])
+
         default_ctypes = {
+            self.BlobDict: {},
+            self.BlobText: "",
             self.Dict: {},
             self.List: [],
             self.LargeString: "",
@@ -230,6 +362,16 @@ class Database:
 
     def configure_model_events(self, env):
         env.log_events = True
+        self.get_shared_version = env.get_cache_version
+        self.credential_models = ("credential", "group", "pool", "service_bus", "user")
+        self.counted_properties = {
+            model: [
+                property
+                for property in {*properties, "is_active"}
+                if property in inspect(vs.models[model]).column_attrs
+            ]
+            for model, properties in vs.properties["dashboard"].items()
+        }
 
         @event.listens_for(self.base, "after_insert", propagate=True)
         def log_instance_creation(mapper, connection, target):
@@ -285,6 +427,67 @@ class Database:
                 )
                 env.log("info", f"UPDATE: {target.type} '{name}': ({changes})")
 
+        @event.listens_for(self.session, "after_flush")
+        def flag_rbac_update(session, context):
+            if any(
+                self.is_rbac_update(instance, new_or_deleted)
+                for instances, new_or_deleted in (
+                    (session.new, True),
+                    (session.deleted, True),
+                    (session.dirty, False),
+                )
+                for instance in instances
+            ):
+                self.update_rbac_version(session)
+
+        @event.listens_for(self.session, "after_commit")
+        def commit_rbac_update(session):
+            if session.info.pop("rbac_update", False):
+                vs.rbac_version += 1
+                env.increment_cache_version("rbac")
+
+        @event.listens_for(self.session, "after_flush")
+        def flag_credential_update(session, context):
+            if any(
+                getattr(instance, "class_type", None) in self.credential_models
+                for instances in (session.new, session.deleted, session.dirty)
+                for instance in instances
+            ):
+                self.update_credential_version(session)
+
+        @event.listens_for(self.session, "after_commit")
+        def commit_credential_update(session):
+            if session.info.pop("credential_update", False):
+                vs.credential_version += 1
+                env.increment_cache_version("credential")
+
+        @event.listens_for(self.session, "after_flush")
+        def collect_counter_deltas(session, context):
+            if not vs.settings["counters"]["active"]:
+                return
+            deltas = session.info.setdefault("counter_deltas", Counter())
+            for instances, sign in (
+                (session.new, 1),
+                (session.deleted, -1),
+                (session.dirty, 0),
+            ):
+                for instance in instances:
+                    instance_deltas = self.get_counter_deltas(instance, sign)
+                    if instance_deltas is None:
+                        session.info["counters_stale"] = True
+                    else:
+                        deltas.update(instance_deltas)
+
+        @event.listens_for(self.session, "after_commit")
+        def commit_counter_deltas(session):
+            if session.info.pop("counters_stale", False):
+                env.counters_reconciliation = None
+            env.update_counters(session.info.pop("counter_deltas", {}))
+
+        @event.listens_for(self.session, "after_rollback")
+        def discard_counter_deltas(session):
+            session.info.pop("counter_deltas", None)
+
         for model in vs.models.values():
             if "configure_events" in vars(model):
                 model.configure_events()
@@ -394,11 +597,18 @@ class Database:
             )
 
     def query(self, model, rbac="read", username=None, properties=None):
-        if properties:
-            entity = [getattr(vs.models[model], property) for property in properties]
-        else:
-            entity = [vs.models[model]]
-        query = self.session.query(*entity)
+        entity, joins = [], []
+        for property in properties or []:
+            attribute = getattr(vs.models[model], property)
+            if hasattr(attribute, "target_collection"):
+                target = aliased(attribute.target_class)
+                relation = getattr(vs.models[model], attribute.target_collection)
+                joins.append((target, relation))
+                attribute = getattr(target, attribute.value_attr)
+            entity.append(attribute)
+        query = self.session.query(*(entity or [vs.models[model]]))
+        for target, relation in joins:
+            query = query.outerjoin(target, relation)
         if rbac:
             user = (
                 current_user
@@ -452,6 +662,17 @@ class Database:
                 f"with the following characteristics: {kwargs}"
             )
 
+    def fetch_many(self, model, property, values, properties=None, **kwargs):
+        values, results = list(dict.fromkeys(values)), []
+        column = getattr(vs.models[model], property)
+        chunk_size = self.transactions["bulk_chunk_size"]
+        for index in range(0, len(values), chunk_size):
+            query = self.query(model, properties=properties, **kwargs)
+            if not query:
+                break
+            results.extend(query.filter(column.in_(values[index : index + chunk_size])))
+        return results
+
     def delete(self, model, **kwargs):
         instance = self.fetch(model, **{"rbac": "edit", **kwargs})
         return self.delete_instance(instance)
@@ -479,6 +700,25 @@ class Database:
                 self.delete_instance(instance, call_delete=model != "file")
             self.session.commit()
 
+    def delete_orphan_blobs(self):
+        references, chunk_size = set(), self.transactions["bulk_chunk_size"]
+        for table in self.base.metadata.tables.values():
+            for column in table.columns:
+                if not isinstance(column.type, self.blob_types):
+                    continue
+                raw_column = type_coerce(column, column.type.impl)
+                query = (
+                    self.session.query(raw_column)
+                    .filter(func.length(raw_column) <= 128)
+                    .yield_per(chunk_size)
+                )
+                for (value,) in query:
+                    if isinstance(value, bytes):
+                        value = value.decode("utf-8", "ignore")
+                    if value.startswith(BlobStore.prefix):
+                        references.add(value)
+        return self.blob_store.delete_orphans(references)
+
     def export(self, model, private_properties=False):
         return [
             instance.to_dict(export=True, private_properties=private_properties)
@@ -523,50 +763,286 @@ class Database:
                     sleep(self.retry_commit_time * (index + 1))
         return instance
 
+    def bulk_insert(self, model, instances):
+        chunk_size = self.transactions["bulk_chunk_size"]
+        mappings = [
+            {**mapping, "type": model}
+            for mapping in self.get_bulk_mappings(model, instances)
+        ]
+        for index in range(0, len(mappings), chunk_size):
+            self.session.bulk_insert_mappings(
+                vs.models[model],
+                mappings[index : index + chunk_size],
+                return_defaults=True,
+            )
+        self.flag_bulk_update()
+        return {mapping["name"]: mapping["id"] for mapping in mappings}
+
+    def bulk_relate(self, relations):
+        deletions, insertions = defaultdict(set), defaultdict(set)
+        updates, chunk_size = defaultdict(list), self.transactions["bulk_chunk_size"]
+        for (model, property), values in relations.items():
+            relation = inspect(vs.models[model]).relationships[property]
+            if relation.direction == MANYTOMANY:
+                ((_, local_column),) = relation.synchronize_pairs
+                ((_, remote_column),) = relation.secondary_synchronize_pairs
+                deletions[local_column].update(values)
+                insertions[relation.secondary].update(
+                    frozenset({(local_column.key, id), (remote_column.key, related_id)})
+                    for id, related_ids in values.items()
+                    for related_id in related_ids
+                )
+            elif relation.direction == MANYTOONE:
+                (column,) = relation.local_columns
+                updates[column].extend(
+                    {"row_id": id, "value": related_ids[0] if related_ids else None}
+                    for id, related_ids in values.items()
+                )
+            else:
+                (column,) = relation.remote_side
+                updates[column].extend(
+                    {"row_id": related_id, "value": id}
+                    for id, related_ids in values.items()
+                    for related_id in related_ids
+                )
+        for column, ids in deletions.items():
+            ids = list(ids)
+            for index in range(0, len(ids), chunk_size):
+                condition = column.in_(ids[index : index + chunk_size])
+                self.session.execute(column.table.delete().where(condition))
+        for table, rows in insertions.items():
+            rows = [dict(row) for row in rows]
+            for index in range(0, len(rows), chunk_size):
+                self.session.execute(table.insert(), rows[index : index + chunk_size])
+        for column, rows in updates.items():
+            statement = (
+                column.table.update()
+                .where(column.table.c.id == bindparam("row_id"))
+                .values({column.key: bindparam("value")})
+            )
+            for index in range(0, len(rows), chunk_size):
+                self.session.execute(statement, rows[index : index + chunk_size])
+        self.flag_bulk_update()
+
+    def bulk_update(self, model, instances, name_map):
+        chunk_size = self.transactions["bulk_chunk_size"]
+        mappings = [
+            {**mapping, "id": name_map[mapping["name"]]}
+            for mapping in self.get_bulk_mappings(model, instances)
+        ]
+        for index in range(0, len(mappings), chunk_size):
+            self.session.bulk_update_mappings(
+                vs.models[model], mappings[index : index + chunk_size]
+            )
+        self.flag_bulk_update()
+
+    def get_bulk_mappings(self, model, instances):
+        columns, mappings = set(inspect(vs.models[model]).column_attrs.keys()), []
+        for instance in instances:
+            mapping = {}
+            for property, value in instance.items():
+                if property == "id" or property not in columns:
+                    continue
+                if vs.model_properties[model].get(property) == "bool":
+                    value = value not in (False, "false")
+                mapping[property] = value
+            mappings.append(mapping)
+        return mappings
+
+    def get_default_rbac(self, model):
+        default_rbac = defaultdict(set)
+        if model not in vs.rbac["rbac_models"]:
+            return default_rbac
+        if current_user:
+            default_rbac["owners"].add(current_user.id)
+            for group in current_user.groups:
+                for access_type in getattr(group, f"{model}_access"):
+                    default_rbac[access_type].add(group.id)
+        group = vs.models["group"]
+        for (group_id,) in self.session.query(group.id).filter_by(
+            force_read_access=True
+        ):
+            default_rbac["rbac_read"].add(group_id)
+        return default_rbac
+
+    def get_device_results(self, parent_runtime, service_id=None):
+        result, device = vs.models["result"], vs.models["device"]
+        query = (
+            self.session.query(result.id, device.id, device.name, result.result)
+            .join(device, result.device_id == device.id)
+            .filter(result.parent_runtime == parent_runtime)
+        )
+        if service_id:
+            query = query.filter(result.service_id == service_id)
+        yield from query.order_by(result.id).yield_per(
+            self.transactions["bulk_chunk_size"]
+        )
+
+    def get_name_map(self, model):
+        table = vs.models[model]
+        return dict(self.session.query(table.name, table.id))
+
+    def get_rbac_ids(self, model, mode, user):
+        settings = vs.settings["rbac_cache"]
+        if not settings["active"]:
+            return
+        key, now = (user.id, model, mode), monotonic()
+        version = (vs.rbac_version, self.get_shared_version("rbac"))
+        cache_version, expiry, ids = vs.rbac_cache.get(key, (None, 0, None))
+        if cache_version == version and expiry > now:
+            return ids
+        table, max_ids = vs.models[model], settings["max_ids"]
+        query = table.rbac_constraints(self.session.query(table.id), model, mode, user)
+        rows = query.limit(max_ids + 1).all()
+        ids = frozenset(id for id, in rows) if len(rows) <= max_ids else None
+        vs.rbac_cache[key] = (version, now + settings["time"], ids)
+        return ids
+
+    def is_rbac_update(self, instance, new_or_deleted):
+        model = getattr(instance, "class_type", None)
+        if model in ("group", "user"):
+            return True
+        elif model not in vs.rbac["rbac_models"]:
+            return False
+        elif new_or_deleted:
+            return True
+        state = inspect(instance)
+        return any(
+            state.attrs[property].history.has_changes()
+            for property in ("admin_only", "owners", *vs.rbac["rbac_models"][model])
+            if property in state.attrs
+        )
+
+    def flag_bulk_update(self):
+        self.session.info["counters_stale"] = True
+        vs.configuration_index_event.set()
+        self.update_credential_version(self.session)
+        self.update_rbac_version(self.session)
+
+    def get_counter_deltas(self, instance, sign):
+        deltas, state = Counter(), inspect(instance)
+        for model, properties in self.counted_properties.items():
+            if not isinstance(instance, vs.models[model]):
+                continue
+            deltas[("total", model)] += sign
+            for property in properties:
+                key = f"{model}/{property}"
+                if sign:
+                    if property not in state.dict:
+                        return
+                    deltas[(key, str(state.dict[property]))] += sign
+                    continue
+                history = state.attrs[property].history
+                if not history.has_changes():
+                    continue
+                elif not history.deleted:
+                    return
+                new_value = history.added[0] if history.added else None
+                deltas[(key, str(history.deleted[0]))] -= 1
+                deltas[(key, str(new_value))] += 1
+        return deltas
+
+    def update_credential_version(self, session):
+        session.info["credential_update"] = True
+        vs.credential_version += 1
+
+    def update_rbac_version(self, session):
+        session.info["rbac_update"] = True
+        vs.rbac_version += 1
+
     def get_credential(
         self, username, name=None, device=None, credential_type="any", optional=False
     ):
-        query = (
-            self.session.query(vs.models["credential"])
-            .join(vs.models["group"], vs.models["credential"].groups)
-            .join(vs.models["user"], vs.models["group"].users)
-        )
-        if device:
-            query = query.join(
-                vs.models["pool"], vs.models["credential"].device_pools
-            ).join(vs.models["device"], vs.models["pool"].devices)
-        query = query.filter(vs.models["user"].name == username)
-        if name:
-            query = query.filter(vs.models["credential"].name == name)
-        if device:
-            query = query.filter(vs.models["device"].name == device.name)
-        if credential_type != "any":
-            query = query.filter(vs.models["credential"].role == credential_type)
-        credentials = max(query.all(), key=attrgetter("priority"), default=None)
+        if device and not name:
+            credential_id = self.get_device_credentials(
+                username, [device], role=credential_type
+            )[device.id]
+            credentials = credential_id and self.fetch(
+                "credential", rbac=None, id=credential_id
+            )
+        else:
+            query = (
+                self.session.query(vs.models["credential"])
+                .join(vs.models["group"], vs.models["credential"].groups)
+                .join(vs.models["user"], vs.models["group"].users)
+                .filter(vs.models["user"].name == username)
+            )
+            if name:
+                query = query.filter(vs.models["credential"].name == name)
+            if device:
+                query = (
+                    query.join(vs.models["pool"], vs.models["credential"].device_pools)
+                    .join(vs.models["device"], vs.models["pool"].devices)
+                    .filter(vs.models["device"].name == device.name)
+                )
+            if credential_type != "any":
+                query = query.filter(vs.models["credential"].role == credential_type)
+            credentials = max(query.all(), key=attrgetter("priority"), default=None)
         if not credentials and not optional:
             raise Exception(f"No matching credentials found for DEVICE '{device.name}'")
         return credentials
 
+    def get_device_credentials(self, username, devices, model="credential", role="any"):
+        settings = vs.settings["credential_cache"]
+        version = (vs.credential_version, self.get_shared_version("credential"))
+        key, now = (model, username, role), monotonic()
+        cache_version, expiry, credentials = vs.credential_cache.get(key, (None, 0, {}))
+        if not settings["active"] or cache_version != version or expiry < now:
+            credentials, expiry = {}, now + settings["time"]
+        table, device_table = vs.models[model], vs.models["device"]
+        users = vs.models["group"].users if model == "credential" else table.users
+        device_ids = list({device.id for device in devices} - set(credentials))
+        chunk_size = self.transactions["bulk_chunk_size"]
+        if device_ids:
+            credentials = dict(credentials)
+        for index in range(0, len(device_ids), chunk_size):
+            chunk = device_ids[index : index + chunk_size]
+            query = (
+                self.session.query(device_table.id, table.id)
+                .select_from(table)
+                .join(vs.models["group"], table.groups)
+                .join(vs.models["user"], users)
+                .join(vs.models["pool"], table.device_pools)
+                .join(device_table, vs.models["pool"].devices)
+                .filter(vs.models["user"].name == username, device_table.id.in_(chunk))
+            )
+            if role != "any":
+                query = query.filter(table.role == role)
+            chunk_credentials = dict.fromkeys(chunk)
+            chunk_credentials.update(query.order_by(table.priority).all())
+            credentials.update(chunk_credentials)
+        if settings["active"] and device_ids:
+            vs.credential_cache[key] = (version, expiry, credentials)
+        return {device.id: credentials[device.id] for device in devices}
+
     def get_service_bus(
         self, username, name=None, device=None, service_bus_type="any", optional=False
     ):
-        query = (
-            self.session.query(vs.models["service_bus"])
-            .join(vs.models["group"], vs.models["service_bus"].groups)
-            .join(vs.models["user"], vs.models["service_bus"].users)
-        )
-        if device:
-            query = query.join(
-                vs.models["pool"], vs.models["service_bus"].device_pools
-            ).join(vs.models["device"], vs.models["pool"].devices)
-        query = query.filter(vs.models["user"].name == username)
-        if name:
-            query = query.filter(vs.models["service_bus"].name == name)
-        if device:
-            query = query.filter(vs.models["device"].name == device.name)
-        if service_bus_type != "any":
-            query = query.filter(vs.models["service_bus"].role == service_bus_type)
-        service_bus = max(query.all(), key=attrgetter("priority"), default=None)
+        if device and not name:
+            service_bus_id = self.get_device_credentials(
+                username, [device], model="service_bus", role=service_bus_type
+            )[device.id]
+            service_bus = service_bus_id and self.fetch(
+                "service_bus", rbac=None, id=service_bus_id
+            )
+        else:
+            query = (
+                self.session.query(vs.models["service_bus"])
+                .join(vs.models["group"], vs.models["service_bus"].groups)
+                .join(vs.models["user"], vs.models["service_bus"].users)
+                .filter(vs.models["user"].name == username)
+            )
+            if name:
+                query = query.filter(vs.models["service_bus"].name == name)
+            if device:
+                query = (
+                    query.join(vs.models["pool"], vs.models["service_bus"].device_pools)
+                    .join(vs.models["device"], vs.models["pool"].devices)
+                    .filter(vs.models["device"].name == device.name)
+                )
+            if service_bus_type != "any":
+                query = query.filter(vs.models["service_bus"].role == service_bus_type)
+            service_bus = max(query.all(), key=attrgetter("priority"), default=None)
         if not service_bus and not optional:
             raise Exception(f"No matching service_bus found for DEVICE '{device.name}'")
         return service_bus
@@ -670,6 +1146,11 @@ class Database:
                 ),
             )
 
+    def store_blob(self, data, force=False):
+        settings = vs.settings["blob_store"]
+        if force or settings["active"] and len(data) > settings["threshold"]:
+            return self.blob_store.write(data)
+
     def cleanup(self):
         self.engine.dispose()
 
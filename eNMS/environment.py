@@ -1,6 +1,8 @@
 from base64 import b64decode, b64encode
+from bisect import bisect_left
 from click import get_current_context
-from collections import defaultdict
+from collections import Counter, defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.fernet import Fernet
 from dramatiq.brokers.redis import RedisBroker
 from dramatiq import set_broker
@@ -9,11 +11,13 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formatdate
 from flask_login import current_user
+from hashlib import sha256
+from hmac import new as hmac_new
 from importlib import import_module
 from json import load
 from logging.config import dictConfig
 from logging import getLogger, info
-from os import getenv, getpid
+from os import getenv, getpid, urandom
 from passlib.hash import argon2
 from pathlib import Path
 from psutil import Process
@@ -26,7 +30,8 @@ from smtplib import SMTP
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import StaleDataError
 from sys import path as sys_path
-from threading import Thread
+from threading import Lock, Thread
+from time import monotonic, sleep
 from traceback import format_exc
 from warnings import warn
 from watchdog.observers.polling import PollingObserver
@@ -62,6 +67,7 @@ class Environment:
             sys_path.append(vs.settings["paths"]["custom_code"])
         self.init_logs()
         self.init_redis()
+        self.init_counters()
         if vs.settings["automation"]["use_task_queue"]:
             self.init_dramatiq()
         self.init_connection_pools()
@@ -105,6 +111,27 @@ class Environment:
         observer.schedule(event_handler, path=str(vs.file_path), recursive=True)
         observer.start()
 
+    def authenticate_rest_user(self, username, password):
+        cache_time = vs.settings["authentication"]["rest_cache_time"]
+        if not cache_time:
+            return self.authenticate_user(username=username, password=password)
+        credentials, now = f"{username}:{password}".encode(), monotonic()
+        key = hmac_new(self.authentication_key, credentials, sha256).digest()
+        expiry, user_id, user_password = self.authentication_cache.get(key, (0, 0, 0))
+        if expiry > now:
+            user = db.fetch("user", allow_none=True, id=user_id, rbac=None)
+            if user and user.password == user_password:
+                return user
+        user = self.authenticate_user(username=username, password=password)
+        if user:
+            self.authentication_cache = {
+                cache_key: value
+                for cache_key, value in self.authentication_cache.items()
+                if value[0] > now
+            }
+            self.authentication_cache[key] = (now + cache_time, user.id, user.password)
+        return user
+
     def authenticate_user(self, **kwargs):
         name, password = kwargs["username"], kwargs["password"]
         print(password)
@@ -138,6 +165,49 @@ class Environment:
                 db.session.commit()
             return user
 
+    def checkin_device_connection(self, key, connection):
+        settings, closed = vs.settings["connection_pool"], []
+        max_connections = settings["max_connections"]
+        with self.device_connection_lock:
+            count = self.device_connection_count[key[1]]
+            if count < settings["max_device_connections"]:
+                self.device_connections.setdefault(key, []).append(
+                    (monotonic(), connection)
+                )
+                self.device_connections.move_to_end(key)
+                self.device_connection_count[key[1]] += 1
+                self.device_connection_total += 1
+            else:
+                closed.append((key, connection))
+            for pool_key, connections in list(self.device_connections.items()):
+                if self.device_connection_total <= max_connections:
+                    break
+                while connections and self.device_connection_total > max_connections:
+                    closed.append((pool_key, connections.pop(0)[1]))
+                    self.remove_device_connection(pool_key)
+        self.close_device_connections(closed)
+
+    def checkout_device_connection(self, key):
+        with self.device_connection_lock:
+            if not self.device_connections.get(key):
+                return
+            _, connection = self.device_connections[key].pop()
+            self.remove_device_connection(key)
+        return connection
+
+    def close_device_connections(self, connections):
+        for (library, device, *_), connection in connections:
+            try:
+                if library == "netmiko":
+                    connection.disconnect()
+                elif library == "ncclient":
+                    connection.close_session()
+                else:
+                    connection.close()
+            except Exception as exc:
+                error = f"Error while closing pooled {library} connection ({exc})"
+                self.log("error", f"{error} to {device}", change_log=False)
+
     def detect_cli(self):
         try:
             return get_current_context().info_name == "flask"
@@ -149,6 +219,20 @@ class Environment:
             password = str.encode(password)
         return self.encrypt(password)
 
+    def get_cache_version(self, name):
+        if not self.redis_queue:
+            return 0
+        return self.redis("get", f"cache_version/{name}") or 0
+
+    def get_counters(self, key):
+        if self.redis_queue:
+            counters = self.redis("hgetall", f"counters/{key}") or {}
+            counters = {field: int(value) for field, value in counters.items()}
+        else:
+            with self.counter_lock:
+                counters = dict(self.counters[key])
+        return {field: value for field, value in counters.items() if value}
+
     def get_password(self, password):
         if not password:
             return
@@ -165,7 +249,12 @@ class Environment:
         end = vs.settings["ssh"]["end_port"]
         return start + int(self.ssh_port) % (end - start)
 
+    def increment_cache_version(self, name):
+        if self.redis_queue:
+            self.redis("incr", f"cache_version/{name}")
+
     def init_authentication(self):
+        self.authentication_cache, self.authentication_key = {}, urandom(32)
         ldap_address, tacacs_address = getenv("LDAP_ADDR"), getenv("TACACS_ADDR")
         try:
             if ldap_address:
@@ -185,6 +274,18 @@ class Environment:
                 f"{protocol}://",
                 HTTPAdapter(max_retries=retry, **vs.settings["requests"]["pool"]),
             )
+        self.device_executor = ThreadPoolExecutor(
+            max_workers=vs.settings["automation"]["max_async_workers"],
+            thread_name_prefix="device",
+        )
+        self.device_connections, self.device_connection_lock = OrderedDict(), Lock()
+        self.device_connection_count, self.device_connection_total = defaultdict(int), 0
+        if vs.settings["connection_pool"]["active"]:
+            Thread(target=self.monitor_device_connections, daemon=True).start()
+
+    def init_counters(self):
+        self.counters, self.counter_lock = defaultdict(Counter), Lock()
+        self.counters_reconciliation = None
 
     def init_dramatiq(self):
         set_broker(
@@ -207,6 +308,7 @@ class Environment:
             self.encrypt, self.decrypt = b64encode, b64decode
 
     def init_logs(self):
+        self.log_lock = Lock()
         folder = vs.path / "logs"
         folder.mkdir(parents=True, exist_ok=True)
         with open(vs.path / "setup" / "logging.json", "r") as logging_config:
@@ -251,30 +353,86 @@ class Environment:
             )
         return logger_settings
 
-    def log_queue(self, runtime, service, log=None, mode="add", start_line=0):
+    def log_queue(self, runtime, service, log=None, mode="add", device=None):
         if self.redis_queue:
             key = f"{runtime}/{service}/logs"
             vs.run_logs[runtime][int(service)] = None
             if mode == "add":
-                log = self.redis("lpush", key, log)
+                commands = [("xadd", key, {"log": log})]
+                if device:
+                    commands.append(("xadd", f"{key}/{device}", {"log": log}))
+                self.redis_pipeline(commands)
             else:
-                log = self.redis("lrange", key, 0, -1)
-                if log:
-                    log = log[::-1][start_line:]
+                log = [entry["log"] for _, entry in self.redis("xrange", key) or []]
         else:
             if mode == "add":
-                return vs.run_logs[runtime][int(service)].append(log)
+                with self.log_lock:
+                    logs = vs.run_logs[runtime][int(service)]
+                    if device:
+                        vs.run_device_logs[runtime][int(service)][device].append(
+                            len(logs)
+                        )
+                    logs.append(log)
             else:
-                full_log = getattr(vs.run_logs[runtime], mode)(int(service), [])
-                log = full_log[start_line:]
+                log = getattr(vs.run_logs[runtime], mode)(int(service), [])
         return log
 
+    def log_stream(self, runtime, service, cursor=0, device=None):
+        if self.redis_queue:
+            key = f"{runtime}/{service}/logs{f'/{device}' if device else ''}"
+            stream = self.redis("xread", {key: cursor or 0})
+            entries = stream[0][1] if stream else []
+            if entries:
+                cursor = entries[-1][0]
+            return [entry["log"] for _, entry in entries], cursor
+        else:
+            cursor, service = int(cursor), int(service)
+            with self.log_lock:
+                logs = vs.run_logs.get(runtime, {}).get(service, [])
+                if device:
+                    device_logs = vs.run_device_logs.get(runtime, {}).get(service, {})
+                    positions = device_logs.get(device, [])
+                    start = bisect_left(positions, cursor)
+                    lines = [logs[position] for position in positions[start:]]
+                else:
+                    lines = logs[cursor:]
+                return lines, len(logs)
+
+    def monitor_device_connections(self):
+        settings = vs.settings["connection_pool"]
+        while True:
+            sleep(settings["cleanup_interval"])
+            expiry, idle_connections = monotonic() - settings["idle_time"], []
+            with self.device_connection_lock:
+                for key, connections in list(self.device_connections.items()):
+                    while connections and connections[0][0] < expiry:
+                        idle_connections.append((key, connections.pop(0)[1]))
+                        self.remove_device_connection(key)
+            self.close_device_connections(idle_connections)
+
     def redis(self, operation, *args, **kwargs):
         try:
             return getattr(self.redis_queue, operation)(*args, **kwargs)
         except (ConnectionError, TimeoutError) as exc:
             self.log("error", f"Redis Queue Unreachable ({exc})", change_log=False)
 
+    def redis_pipeline(self, commands):
+        try:
+            pipeline = self.redis_queue.pipeline(transaction=False)
+            for operation, *args in commands:
+                getattr(pipeline, operation)(*args)
+            return pipeline.execute()
+        except (ConnectionError, TimeoutError) as exc:
+            self.log("error", f"Redis Queue Unreachable ({exc})", change_log=False)
+
+    def remove_device_connection(self, key):
+        self.device_connection_count[key[1]] -= 1
+        self.device_connection_total -= 1
+        if not self.device_connection_count[key[1]]:
+            self.device_connection_count.pop(key[1])
+        if not self.device_connections[key]:
+            self.device_connections.pop(key)
+
     def send_email(
         self,
         subject,
@@ -306,5 +464,34 @@ class Environment:
                 server.login(vs.settings["mail"]["username"], password)
             server.sendmail(sender, recipients.split(","), message.as_string())
 
+    def set_counters(self, counters):
+        if self.redis_queue:
+            commands = []
+            for key, values in counters.items():
+                commands.append(("delete", f"counters/{key}"))
+                if values:
+                    commands.append(("hset", f"counters/{key}", None, None, values))
+            self.redis_pipeline(commands)
+        else:
+            with self.counter_lock:
+                self.counters = defaultdict(
+                    Counter, {key: Counter(values) for key, values in counters.items()}
+                )
+        self.counters_reconciliation = monotonic()
+
+    def update_counters(self, deltas):
+        deltas = {key: delta for key, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        elif self.redis_queue:
+            self.redis_pipeline(
+                ("hincrby", f"counters/{key}", field, delta)
+                for (key, field), delta in deltas.items()
+            )
+        else:
+            with self.counter_lock:
+                for (key, field), delta in deltas.items():
+                    self.counters[key][field] += delta
+
 
 env = Environment()
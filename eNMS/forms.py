@@ -445,6 +445,10 @@ class ExcelExportForm(BaseForm):
     action = "eNMS.inventory.exportTopology"
     form_type = HiddenField(default="excel_export")
     export_filename = StringField("Filename")
+    export_format = SelectField(
+        "Format",
+        choices=(("xls", "XLS (legacy)"), ("xlsx", "XLSX"), ("csv", "CSV")),
+    )
 
 
 class ExcelImportForm(BaseForm):
@@ -812,6 +816,11 @@ class ServiceForm(BaseForm):
         no_search=True,
     )
     multiprocessing = BooleanField("Multiprocessing", help="common/multiprocessing")
+    multiprocessing_mode = SelectField(
+        "Multiprocessing Mode",
+        choices=(("threads", "Thread Pool"), ("asyncio", "Asyncio Event Loop")),
+        no_search=True,
+    )
     max_processes = IntegerField("Maximum number of processes", default=15)
     validation_condition = SelectField(
         choices=(
@@ -900,6 +909,7 @@ class ServiceForm(BaseForm):
             "device_query",
             "device_query_property",
             "multiprocessing",
+            "multiprocessing_mode",
             "max_processes",
         ],
         "step3-2": [
@@ -988,13 +998,14 @@ class ServiceForm(BaseForm):
                 f"The validation method is set to '{self.validation_method.data}'"
                 f" and the matching value is empty: these do no match."
             )
-        too_many_threads_error = (
-            self.max_processes.data > vs.settings["automation"]["max_process"]
-        )
+        asyncio_mode = self.multiprocessing_mode.data == "asyncio"
+        max_setting = "max_async_workers" if asyncio_mode else "max_process"
+        max_processes = vs.settings["automation"][max_setting]
+        too_many_threads_error = self.max_processes.data > max_processes
         if too_many_threads_error:
             self.max_processes.errors.append(
                 "The number of threads used for multiprocessing must be "
-                f"less than {vs.settings['automation']['max_process']}."
+                f"less than {max_processes}."
             )
         shared_service_error = not self.shared.data and len(self.workflows.data) > 1
         if shared_service_error:
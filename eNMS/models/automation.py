@@ -1,15 +1,16 @@
 from copy import deepcopy
 from flask_login import current_user
 from functools import wraps
+from json import dumps, loads
 from os import environ, getpid
 from requests import get, post
 from requests.exceptions import ConnectionError, MissingSchema, ReadTimeout
-from sqlalchemy import Boolean, case, ForeignKey, Integer
+from sqlalchemy import Boolean, case, Float, ForeignKey, Integer, or_
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import deferred, relationship
+from zlib import compress, decompress
 
-from eNMS.controller import controller
 from eNMS.database import db
 from eNMS.environment import env
 from eNMS.models.base import AbstractBase
@@ -108,6 +109,7 @@ class Service(AbstractBase):
     )
     maximum_runs = db.Column(Integer, default=1)
     multiprocessing = db.Column(Boolean, default=False)
+    multiprocessing_mode = db.Column(db.TinyString, default="threads")
     max_processes = db.Column(Integer, default=5)
     status = db.Column(db.TinyString, default="Idle")
     validation_condition = db.Column(db.TinyString, default="none")
@@ -242,7 +244,7 @@ class Result(AbstractBase):
     labels = db.Column(db.LargeString)
     runtime = db.Column(db.TinyString)
     duration = db.Column(db.TinyString)
-    result = deferred(db.Column(db.Dict))
+    result = deferred(db.Column(db.BlobDict))
     creator = db.Column(db.SmallString)
     run_id = db.Column(Integer, ForeignKey("run.id", ondelete="cascade"))
     run = relationship("Run", back_populates="results", foreign_keys="Result.run_id")
@@ -294,13 +296,103 @@ class Result(AbstractBase):
             constraints.append(vs.models["result"].parent_runtime == kwargs["runtime"])
         return constraints
 
+    @classmethod
+    def get_row_defaults(cls):
+        defaults = {}
+        for column in cls.__table__.columns:
+            if column.key == "id":
+                continue
+            is_scalar = getattr(column.default, "is_scalar", False)
+            defaults[column.key] = column.default.arg if is_scalar else None
+        return defaults
+
+
+class ResultMetric(AbstractBase):
+    __tablename__ = type = "result_metric"
+    private = True
+    log_change = False
+    id = db.Column(Integer, primary_key=True)
+    runtime = db.Column(db.TinyString, index=True)
+    parent_runtime = db.Column(db.TinyString, index=True)
+    success = db.Column(Boolean, default=False)
+    duration = db.Column(Float, default=0.0)
+    labels = db.Column(db.LargeString)
+    creator = db.Column(db.SmallString)
+    run_id = db.Column(Integer, ForeignKey("run.id", ondelete="cascade"), index=True)
+    run = relationship(
+        "Run", back_populates="metrics", foreign_keys="ResultMetric.run_id"
+    )
+    device_id = db.Column(
+        Integer, ForeignKey("device.id", ondelete="cascade"), index=True
+    )
+    device = relationship("Device", foreign_keys="ResultMetric.device_id")
+    device_name = association_proxy("device", "name")
+    service_id = db.Column(
+        Integer, ForeignKey("service.id", ondelete="cascade"), index=True
+    )
+    service = relationship("Service", foreign_keys="ResultMetric.service_id")
+    service_name = association_proxy(
+        "service", "scoped_name", info={"name": "service_name"}
+    )
+    workflow_id = db.Column(Integer, ForeignKey("workflow.id", ondelete="cascade"))
+    workflow = relationship("Workflow", foreign_keys="ResultMetric.workflow_id")
+    workflow_name = association_proxy(
+        "workflow", "scoped_name", info={"name": "workflow_name"}
+    )
+
+    @classmethod
+    def rbac_filter(cls, *args):
+        return super().rbac_filter(*args, join_class="service")
+
+    @classmethod
+    def filtering_constraints(cls, **kwargs):
+        constraints = []
+        if kwargs.get("since"):
+            constraints.append(cls.runtime >= kwargs["since"])
+        if kwargs.get("until"):
+            constraints.append(cls.runtime < kwargs["until"])
+        return constraints
+
+    @staticmethod
+    def get_seconds(duration):
+        days, _, time = str(duration).rpartition(", ")
+        try:
+            hours, minutes, seconds = map(float, time.split(":"))
+        except ValueError:
+            return None
+        days = int(days.split()[0]) if days else 0
+        return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+    @classmethod
+    def store(cls, rows):
+        properties = (
+            "runtime",
+            "parent_runtime",
+            "success",
+            "labels",
+            "creator",
+            "run_id",
+            "device_id",
+            "service_id",
+            "workflow_id",
+        )
+        metrics = [
+            {
+                **{property: row.get(property) for property in properties},
+                "duration": cls.get_seconds(row.get("duration")),
+            }
+            for row in rows
+        ]
+        if metrics:
+            db.session.execute(cls.__table__.insert(), metrics)
+
 
 class ServiceLog(AbstractBase):
     __tablename__ = type = "service_log"
     private = True
     log_change = False
     id = db.Column(Integer, primary_key=True)
-    content = db.Column(db.LargeString)
+    content = db.Column(db.BlobText)
     runtime = db.Column(db.TinyString)
     service_id = db.Column(Integer, ForeignKey("service.id"))
     service = relationship("Service", foreign_keys="ServiceLog.service_id")
@@ -314,7 +406,7 @@ class ServiceReport(AbstractBase):
     private = True
     log_change = False
     id = db.Column(Integer, primary_key=True)
-    content = db.Column(db.LargeString)
+    content = db.Column(db.BlobText)
     runtime = db.Column(db.TinyString)
     service_id = db.Column(Integer, ForeignKey("service.id"))
     service = relationship("Service", foreign_keys="ServiceReport.service_id")
@@ -371,7 +463,13 @@ class Run(AbstractBase):
     worker_id = db.Column(Integer, ForeignKey("worker.id"))
     worker = relationship("Worker", back_populates="runs")
     state = db.Column(db.Dict, info={"log_change": False})
+    states = relationship(
+        "RunState", back_populates="run", cascade="all, delete-orphan"
+    )
     results = relationship("Result", back_populates="run", cascade="all, delete-orphan")
+    metrics = relationship(
+        "ResultMetric", back_populates="run", cascade="all, delete-orphan"
+    )
     model_properties = {
         "progress": "str",
         "server_properties": "dict",
@@ -407,28 +505,73 @@ class Run(AbstractBase):
     def worker_properties(self):
         return self.worker.base_properties
 
-    def get_state(self):
+    def get_state(self, path=None, children=True):
         if self.state:
-            return self.state
+            state = self.state
+        elif self.status != "Running":
+            return self.get_stored_state(path, children)
         elif env.redis_queue:
-            keys = env.redis("keys", f"{self.runtime}/state/*")
-            if not keys:
-                return {}
-            data, state = list(zip(keys, env.redis("mget", *keys))), {}
-            for log, value in data:
-                inner_store, (*path, last_key) = state, log.split("/")[2:]
-                for key in path:
-                    inner_store = inner_store.setdefault(key, {})
+            key, state = f"{self.runtime}/state", {}
+            data = env.redis("hgetall", key) or {}
+            list_fields = sorted(env.redis("smembers", f"{key}/lists") or [])
+            if list_fields:
+                commands = [
+                    ("lrange", f"{key}/{field}", 0, -1) for field in list_fields
+                ]
+                data.update(zip(list_fields, env.redis_pipeline(commands) or []))
+            for field, value in data.items():
+                inner_store, (*path_keys, last_key) = state, field.split("/")
+                for path_key in path_keys:
+                    inner_store = inner_store.setdefault(path_key, {})
                 if value in ("False", "True"):
                     value = value == "True"
                 inner_store[last_key] = value
-            return state
         else:
-            return vs.run_states[self.runtime]
+            state = vs.run_states[self.runtime]
+        if path is None:
+            return state
+        return {
+            key: value
+            for key, value in state.items()
+            if key == path
+            or ">" not in key
+            or (
+                children
+                and key.startswith(f"{path}>")
+                and ">" not in key[len(path) + 1 :]
+            )
+        }
+
+    def get_stored_state(self, path=None, children=True):
+        table = vs.models["run_state"]
+        query = db.session.query(table.path, table.content).filter(
+            table.run_id == self.id
+        )
+        if path is not None:
+            constraints = [table.path == path, ~table.path.contains(">")]
+            if children:
+                constraints.append(
+                    table.path.like(f"{path}>%") & ~table.path.like(f"{path}>%>%")
+                )
+            query = query.filter(or_(*constraints))
+        return {path: loads(decompress(content)) for path, content in query}
+
+    def store_state(self, state):
+        rows = [
+            {
+                "run_id": self.id,
+                "path": path,
+                "content": compress(dumps(value, default=str).encode("utf-8")),
+            }
+            for path, value in state.items()
+        ]
+        if rows:
+            db.session.execute(vs.models["run_state"].__table__.insert(), rows)
 
     @property
     def progress(self):
-        progress = self.get_state().get(str(self.service_id), {}).get("progress")
+        state = self.get_state(str(self.service_id), children=False)
+        progress = state.get(str(self.service_id), {}).get("progress")
         if not progress:
             return
         try:
@@ -450,39 +593,46 @@ class Run(AbstractBase):
         worker.current_runs = 1 if not worker.current_runs else worker.current_runs + 1
         server.current_runs += 1
         self.worker = worker
-        vs.run_targets[self.runtime] = set(
-            device.id
-            for device in controller.filtering(
-                "device", properties=["id"], rbac="target", username=self.creator
-            )
-        )
         if not self.trigger:
             run_type = "Parameterized" if self.parameterized_run else "Regular"
             self.trigger = f"{run_type} Run"
-        self.service_run = Runner(
-            self,
-            payload=deepcopy(self.payload),
-            service=self.service,
-            is_main_run=True,
-            restart_run=self.restart_run,
-            parameterized_run=self.parameterized_run,
-            parent_runtime=self.runtime,
-            path=self.path,
-            placeholder=self.placeholder,
-            properties=self.properties,
-            start_services=self.start_services,
-            task=self.task,
-            trigger=self.trigger,
-        )
-        self.payload = self.service_run.payload
-        worker.current_runs -= 1
-        server.current_runs -= 1
-        db.session.commit()
-        vs.run_targets.pop(self.runtime)
-        vs.run_services.pop(self.runtime)
+        vs.run_registry.register(self.runtime)
+        try:
+            self.service_run = Runner(
+                self,
+                payload=deepcopy(self.payload),
+                service=self.service,
+                is_main_run=True,
+                restart_run=self.restart_run,
+                parameterized_run=self.parameterized_run,
+                parent_runtime=self.runtime,
+                path=self.path,
+                placeholder=self.placeholder,
+                properties=self.properties,
+                start_services=self.start_services,
+                task=self.task,
+                trigger=self.trigger,
+            )
+            self.payload = self.service_run.payload
+            worker.current_runs -= 1
+            server.current_runs -= 1
+            db.session.commit()
+            vs.run_services.pop(self.runtime)
+        finally:
+            vs.run_registry.complete(self.runtime)
         return self.service_run.results
 
 
+class RunState(AbstractBase):
+    __tablename__ = type = "run_state"
+    private = True
+    id = db.Column(Integer, primary_key=True)
+    path = db.Column(db.SmallString, index=True)
+    content = db.Column(db.Binary)
+    run_id = db.Column(Integer, ForeignKey("run.id", ondelete="cascade"), index=True)
+    run = relationship("Run", back_populates="states", foreign_keys="RunState.run_id")
+
+
 class Task(AbstractBase):
     __tablename__ = type = class_type = "task"
     id = db.Column(Integer, primary_key=True)
@@ -112,8 +112,16 @@ class AbstractBase(db.base):
         model = join_class or getattr(cls, "class_type", None)
         if model not in vs.rbac["rbac_models"]:
             return query
+        ids = db.get_rbac_ids(model, mode, user)
+        if ids is not None:
+            column = getattr(cls, f"{join_class}_id") if join_class else cls.id
+            return query.filter(column.in_(ids))
         if join_class:
             query = query.join(getattr(cls, join_class))
+        return cls.rbac_constraints(query, model, mode, user)
+
+    @staticmethod
+    def rbac_constraints(query, model, mode, user):
         user_group = [group.id for group in user.groups]
         property = getattr(vs.models[model], f"rbac_{mode}")
         rbac_constraint = property.any(vs.models["group"].id.in_(user_group))
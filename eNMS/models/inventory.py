@@ -1,8 +1,30 @@
-from re import search, sub
-from sqlalchemy import and_, Boolean, event, ForeignKey, Integer, or_
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+from functools import lru_cache
+from hashlib import sha256
+from json import dumps, loads
+from logging import error
+from os import replace
+from re import compile, error as RegexError, IGNORECASE, search, sub
+from sqlalchemy import (
+    and_,
+    bindparam,
+    Boolean,
+    event,
+    Float,
+    ForeignKey,
+    inspect,
+    Integer,
+    or_,
+)
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import backref, deferred, relationship
 from sqlalchemy.schema import UniqueConstraint
+from tempfile import NamedTemporaryFile
+from threading import Thread
+from time import time
+from traceback import format_exc
+from zlib import compress, decompress
 
 from eNMS.controller import controller
 from eNMS.models.base import AbstractBase
@@ -79,6 +101,12 @@ class Device(Node):
     configuration = deferred(db.Column(db.LargeString, info={"log_change": False}))
     operational_data = deferred(db.Column(db.LargeString, info={"log_change": False}))
     specialized_data = deferred(db.Column(db.LargeString, info={"log_change": False}))
+    last_index_update = db.Column(
+        Float,
+        default=time,
+        onupdate=time,
+        info={"log_change": False, "model_properties": False},
+    )
     gateways = relationship(
         "Gateway", secondary=db.device_gateway_table, back_populates="devices"
     )
@@ -99,6 +127,9 @@ class Device(Node):
     sessions = relationship(
         "Session", back_populates="device", cascade="all, delete-orphan"
     )
+    configuration_versions = relationship(
+        "ConfigurationVersion", back_populates="device", cascade="all, delete-orphan"
+    )
 
     @classmethod
     def database_init(cls):
@@ -108,6 +139,130 @@ class Device(Node):
                 setattr(cls, f"last_{property}_{timestamp}", column)
         return cls
 
+    @classmethod
+    def configure_events(cls):
+        properties = vs.settings["configuration_index"]["properties"]
+
+        @event.listens_for(cls, "after_insert", propagate=True)
+        def index_device(mapper, connection, target):
+            for property in properties:
+                index = vs.configuration_index.get(property)
+                if index is None:
+                    continue
+                value = target.__dict__.get(property)
+                index[target.id] = (None, *cls.get_signature(value))
+
+    @classmethod
+    def filtering_constraints(cls, **kwargs):
+        constraints, form = [], kwargs.get("form", {})
+        settings = vs.settings["configuration_index"]
+        if not settings["active"]:
+            return constraints
+        for property in settings["properties"]:
+            value = form.get(property)
+            if (
+                not isinstance(value, str)
+                or len(value) < 3
+                or form.get(f"{property}_invert")
+                or form.get(f"{property}_filter") not in (None, "inclusion", "equality")
+            ):
+                continue
+            candidates = cls.get_configuration_candidates(property, value)
+            if candidates is None or len(candidates) > settings["max_candidates"]:
+                continue
+            since = vs.configuration_index_time[property] - settings["refresh_margin"]
+            constraints.append(
+                or_(cls.id.in_(candidates), cls.last_index_update > since)
+            )
+        return constraints
+
+    @staticmethod
+    def get_trigrams(value):
+        value = (value or "").lower()
+        return {value[index : index + 3] for index in range(len(value) - 2)}
+
+    @classmethod
+    def get_signature(cls, value):
+        trigrams = cls.get_trigrams(value)
+        bits = len(trigrams) * vs.settings["configuration_index"]["bits_per_trigram"]
+        size = max(64, 1 << (bits - 1).bit_length())
+        signature = bytearray(size // 8)
+        for trigram in trigrams:
+            position = hash(trigram) & (size - 1)
+            signature[position >> 3] |= 1 << (position & 7)
+        return size, int.from_bytes(signature, "little")
+
+    @classmethod
+    def build_configuration_index(cls, property):
+        build_time, index = time(), {}
+        query = db.session.query(cls.id, cls.last_index_update, getattr(cls, property))
+        for device_id, marker, value in query.yield_per(500):
+            index[device_id] = (marker, *cls.get_signature(value))
+        vs.configuration_index[property] = index
+        vs.configuration_index_time[property] = build_time
+
+    @classmethod
+    def refresh_configuration_index(cls, property):
+        refresh_time = time()
+        index, margin = (
+            vs.configuration_index[property],
+            vs.settings["configuration_index"]["refresh_margin"],
+        )
+        since = vs.configuration_index_time[property] - margin
+        markers = db.session.query(cls.id, cls.last_index_update).filter(
+            cls.last_index_update > since
+        )
+        updated_ids = [
+            device_id
+            for device_id, marker in markers
+            if device_id not in index or index[device_id][0] != marker
+        ]
+        for position in range(0, len(updated_ids), 500):
+            query = db.session.query(
+                cls.id, cls.last_index_update, getattr(cls, property)
+            ).filter(cls.id.in_(updated_ids[position : position + 500]))
+            for device_id, marker, value in query:
+                index[device_id] = (marker, *cls.get_signature(value))
+        vs.configuration_index_time[property] = refresh_time
+
+    @classmethod
+    def update_configuration_index(cls):
+        settings = vs.settings["configuration_index"]
+        while True:
+            for property in settings["properties"]:
+                try:
+                    if property in vs.configuration_index:
+                        cls.refresh_configuration_index(property)
+                    else:
+                        cls.build_configuration_index(property)
+                except Exception:
+                    error(f"Configuration index update failed ({format_exc()})")
+                finally:
+                    db.session.remove()
+            vs.configuration_index_event.wait(settings["refresh_interval"])
+            vs.configuration_index_event.clear()
+
+    @classmethod
+    def get_configuration_candidates(cls, property, value):
+        if not vs.configuration_index_thread:
+            vs.configuration_index_thread = Thread(
+                target=cls.update_configuration_index, daemon=True
+            )
+            vs.configuration_index_thread.start()
+        index = vs.configuration_index.get(property)
+        if index is None:
+            return
+        trigrams, masks = cls.get_trigrams(value), {}
+        candidates = []
+        for device_id, (_, size, signature) in list(index.items()):
+            if size not in masks:
+                masks[size] = sum(
+                    {1 << (hash(trigram) & (size - 1)) for trigram in trigrams}
+                )
+            if signature & masks[size] == masks[size]:
+                candidates.append(device_id)
+        return candidates
+
     def get_neighbors(self, object_type, direction="both", **link_constraints):
         filters = [
             vs.models["link"].destination == self,
@@ -308,6 +463,49 @@ class Pool(AbstractBase):
                 number = getattr(target, f"{value.class_type}_number")
                 setattr(target, f"{value.class_type}_number", number - 1)
 
+        @event.listens_for(db.session, "before_flush")
+        def update_pools(session, *_):
+            if not vs.settings["pools"]["incremental_update"]:
+                return
+            instances = [
+                instance
+                for instance in session.new | session.dirty
+                if getattr(instance, "class_type", None) in cls.models
+                and instance not in session.deleted
+                and (instance in session.new or cls.filtering_changes(instance))
+            ]
+            if not instances:
+                return
+            pools = session.query(cls).filter_by(manually_defined=False).all()
+            for instance in instances:
+                cls.update_instance_pools(instance, pools)
+
+    @classmethod
+    def filtering_changes(cls, instance):
+        state = inspect(instance)
+        for property in vs.properties["filtering"][instance.class_type]:
+            if property not in state.attrs:
+                descriptor = getattr(type(instance), property, None)
+                property = getattr(descriptor, "target_collection", None)
+            if property in state.attrs and state.attrs[property].history.has_changes():
+                return True
+        return False
+
+    @classmethod
+    def update_instance_pools(cls, instance, pools):
+        matcher = cls.compile_criteria(instance.class_type, pools)
+        values = {
+            property: getattr(instance, property) for property in matcher["properties"]
+        }
+        pool_ids = cls.match_instance(matcher, values)
+        matching_pools = {pool for pool in pools if pool.id in pool_ids}
+        current_pools = set(instance.pools)
+        for pool in matching_pools - current_pools:
+            instance.pools.append(pool)
+        for pool in current_pools - matching_pools:
+            if not pool.manually_defined:
+                instance.pools.remove(pool)
+
     @classmethod
     def database_init(cls):
         for model in cls.models:
@@ -348,19 +546,171 @@ class Pool(AbstractBase):
 
     def update(self, **kwargs):
         super().update(**kwargs)
+        vs.pool_matchers.clear()
         if not kwargs.get("migration_import"):
             self.update_last_modified_properties()
 
+    def get_criteria(self, model):
+        criteria = []
+        for property in vs.properties["filtering"][model]:
+            value = getattr(self, f"{model}_{property}")
+            match_type = getattr(self, f"{model}_{property}_match")
+            invert_type = getattr(self, f"{model}_{property}_invert")
+            if not value and match_type != "empty":
+                continue
+            criteria.append((property, value, match_type, invert_type))
+        return criteria
+
+    @staticmethod
+    def compile_property(value, match_type, invert_type):
+        mysql = db.dialect.startswith(("mariadb", "mysql"))
+        lowercase = (
+            match_type == "equality"
+            and mysql
+            or match_type == "inclusion"
+            and db.dialect != "postgresql"
+        )
+        if lowercase:
+            value = value.lower()
+        if value in ("bool-true", "bool-false"):
+            check = str(value == "bool-true").__eq__
+        elif match_type == "equality":
+            check = value.__eq__
+        elif match_type == "empty":
+            check = "".__eq__
+        elif match_type == "inclusion":
+
+            def check(property_value):
+                return value in property_value
+
+        else:
+            try:
+                check = compile(value, IGNORECASE if mysql else 0).search
+            except RegexError:
+                return lambda _: False
+
+        def match(property_value):
+            if property_value is None:
+                return False
+            property_value = str(property_value)
+            if lowercase:
+                property_value = property_value.lower()
+            return bool(check(property_value)) != invert_type
+
+        return match
+
+    @classmethod
+    def compile_criteria(cls, model, pools):
+        key = tuple((pool.id, pool.last_modified) for pool in pools)
+        if model in vs.pool_matchers and vs.pool_matchers[model][0] == key:
+            return vs.pool_matchers[model][1]
+        matcher = {
+            "checks": defaultdict(list),
+            "equality": defaultdict(lambda: defaultdict(set)),
+            "equality_count": Counter(),
+            "lowercase": db.dialect.startswith(("mariadb", "mysql")),
+            "pools": [],
+            "properties": set(),
+        }
+        for pool in pools:
+            criteria = pool.get_criteria(model)
+            if pool.manually_defined or not criteria:
+                continue
+            matcher["pools"].append(pool.id)
+            for property, value, match_type, invert_type in criteria:
+                matcher["properties"].add(property)
+                if (
+                    match_type == "equality"
+                    and not invert_type
+                    and value not in ("bool-true", "bool-false")
+                ):
+                    value = value.lower() if matcher["lowercase"] else value
+                    matcher["equality"][property][value].add(pool.id)
+                    matcher["equality_count"][pool.id] += 1
+                else:
+                    check = cls.compile_property(value, match_type, invert_type)
+                    matcher["checks"][pool.id].append((property, check))
+        vs.pool_matchers[model] = (key, matcher)
+        return matcher
+
+    @staticmethod
+    def match_instance(matcher, values):
+        equality_matches = Counter()
+        for property, index in matcher["equality"].items():
+            value = values.get(property)
+            if value is None:
+                continue
+            value = str(value).lower() if matcher["lowercase"] else str(value)
+            equality_matches.update(index.get(value, ()))
+        return {
+            pool_id
+            for pool_id in matcher["pools"]
+            if equality_matches[pool_id] == matcher["equality_count"][pool_id]
+            and all(
+                check(values.get(property))
+                for property, check in matcher["checks"][pool_id]
+            )
+        }
+
+    @classmethod
+    def compute_pools(cls, pools):
+        db.session.flush()
+        for model in cls.models:
+            table = getattr(db, f"pool_{model}_table")
+            matcher = cls.compile_criteria(model, pools)
+            properties = sorted(matcher["properties"])
+            query = db.query(model, rbac=None, properties=["id", *properties])
+            memberships = set()
+            if matcher["pools"]:
+                for instance_id, *row in query.yield_per(1000):
+                    pool_ids = cls.match_instance(matcher, dict(zip(properties, row)))
+                    memberships |= {(pool_id, instance_id) for pool_id in pool_ids}
+            computed_pools = [pool.id for pool in pools if not pool.manually_defined]
+            instance_column = table.c[f"{model}_id"]
+            existing_memberships = set(
+                db.session.query(table.c.pool_id, instance_column).filter(
+                    table.c.pool_id.in_(computed_pools)
+                )
+            )
+            removed_memberships = existing_memberships - memberships
+            added_memberships = memberships - existing_memberships
+            if removed_memberships or added_memberships:
+                db.update_credential_version(db.session)
+            if removed_memberships:
+                db.session.execute(
+                    table.delete().where(
+                        and_(
+                            table.c.pool_id == bindparam("pool"),
+                            instance_column == bindparam("instance"),
+                        )
+                    ),
+                    [
+                        {"pool": pool_id, "instance": instance_id}
+                        for pool_id, instance_id in removed_memberships
+                    ],
+                )
+            if added_memberships:
+                db.session.execute(
+                    table.insert(),
+                    [
+                        {"pool_id": pool_id, f"{model}_id": instance_id}
+                        for pool_id, instance_id in added_memberships
+                    ],
+                )
+            pool_count = Counter(pool_id for pool_id, _ in memberships)
+            for pool in pools:
+                if pool.manually_defined:
+                    number = len(getattr(pool, f"{model}s"))
+                else:
+                    number = pool_count[pool.id]
+                setattr(pool, f"{model}_number", number)
+
     def compute_pool(self):
         for model in self.models:
             if not self.manually_defined:
                 kwargs = {"bulk": "object", "rbac": None, "form": {}}
-                for property in vs.properties["filtering"][model]:
-                    value = getattr(self, f"{model}_{property}")
-                    match_type = getattr(self, f"{model}_{property}_match")
-                    invert_type = getattr(self, f"{model}_{property}_invert")
-                    if not value and match_type != "empty":
-                        continue
+                criteria = self.get_criteria(model)
+                for property, value, match_type, invert_type in criteria:
                     kwargs["form"].update(
                         {
                             property: value,
@@ -374,6 +724,7 @@ class Pool(AbstractBase):
                     instances = []
                 table = getattr(db, f"pool_{model}_table")
                 db.session.execute(table.delete().where(table.c.pool_id == self.id))
+                db.update_credential_version(db.session)
                 if instances:
                     values = [
                         {"pool_id": self.id, f"{model}_id": instance.id}
@@ -392,9 +743,98 @@ class Session(AbstractBase):
     name = db.Column(db.SmallString, unique=True)
     timestamp = db.Column(db.TinyString)
     user = db.Column(db.SmallString)
-    content = deferred(db.Column(db.LargeString, info={"log_change": False}))
+    content = deferred(db.Column(db.BlobText, info={"log_change": False}))
     device_id = db.Column(Integer, ForeignKey("device.id"))
     device = relationship(
         "Device", back_populates="sessions", foreign_keys="Session.device_id"
     )
     device_name = association_proxy("device", "name")
+
+
+class ConfigurationVersion(AbstractBase):
+    __tablename__ = type = "configuration_version"
+    private = True
+    id = db.Column(Integer, primary_key=True)
+    property = db.Column(db.TinyString)
+    hash = db.Column(db.TinyString, index=True)
+    timestamp = db.Column(db.TinyString)
+    device_id = db.Column(Integer, ForeignKey("device.id"), index=True)
+    device = relationship(
+        "Device",
+        back_populates="configuration_versions",
+        foreign_keys="ConfigurationVersion.device_id",
+    )
+    device_name = association_proxy("device", "name")
+
+    @classmethod
+    def object_path(cls, hash):
+        store_path = vs.path / vs.settings["configuration_store"]["path"]
+        return store_path / hash[:2] / hash
+
+    @classmethod
+    def read_object(cls, hash):
+        with open(cls.object_path(hash), "rb") as file:
+            return loads(decompress(file.read()))
+
+    @classmethod
+    @lru_cache(maxsize=vs.settings["configuration_store"]["cache_size"])
+    def get_content(cls, hash):
+        stored_object = cls.read_object(hash)
+        if "content" in stored_object:
+            return stored_object["content"]
+        base_lines = cls.get_content(stored_object["base"]).splitlines(True)
+        content = []
+        for operation, *arguments in stored_object["delta"]:
+            if operation == "=":
+                content.extend(base_lines[arguments[0] : arguments[1]])
+            else:
+                content.append(arguments[0])
+        return "".join(content)
+
+    @classmethod
+    def write_object(cls, hash, value, base_hash=None):
+        stored_object = {"content": value, "depth": 0}
+        snapshot_interval = vs.settings["configuration_store"]["snapshot_interval"]
+        if base_hash and cls.object_path(base_hash).exists():
+            depth = cls.read_object(base_hash)["depth"] + 1
+            if depth < snapshot_interval:
+                lines = value.splitlines(True)
+                matcher = SequenceMatcher(
+                    None, cls.get_content(base_hash).splitlines(True), lines
+                )
+                delta = [
+                    ("=", i1, i2) if tag == "equal" else ("+", "".join(lines[j1:j2]))
+                    for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+                    if tag == "equal" or j1 != j2
+                ]
+                if len(dumps(delta)) < len(value):
+                    stored_object = {"base": base_hash, "delta": delta, "depth": depth}
+        path = cls.object_path(hash)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with NamedTemporaryFile(dir=path.parent, delete=False) as file:
+            file.write(compress(dumps(stored_object).encode("utf-8")))
+        replace(file.name, path)
+
+    @staticmethod
+    def get_hash(value):
+        return sha256(value.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def store(cls, device, property, value, timestamp, deduplicate=True):
+        if not vs.settings["configuration_store"]["active"] or value is None:
+            return
+        hash = cls.get_hash(value)
+        last_version = (
+            db.session.query(cls)
+            .filter_by(device_id=device.id, property=property)
+            .order_by(cls.timestamp.desc(), cls.id.desc())
+            .first()
+        )
+        if deduplicate and last_version and last_version.hash == hash:
+            return
+        if not cls.object_path(hash).exists():
+            cls.write_object(hash, value, last_version.hash if last_version else None)
+        version = cls(
+            device_id=device.id, property=property, hash=hash, timestamp=timestamp
+        )
+        db.session.add(version)
@@ -71,6 +71,9 @@ class NapalmBackupService(ConnectionService):
             duration = f"{(datetime.now() - runtime).total_seconds()}s"
             setattr(device, f"last_{self.property}_duration", duration)
             setattr(device, f"last_{self.property}_update", str(runtime))
+            vs.models["configuration_version"].store(
+                device, self.property, result, str(runtime)
+            )
             run.update_configuration_properties(path, self.property, device)
         except Exception as exc:
             setattr(device, f"last_{self.property}_status", "Failure")
@@ -83,6 +83,9 @@ class ScrapliBackupService(ConnectionService):
                 with open(path / self.property, "w") as file:
                     file.write(result)
                 setattr(device, f"last_{self.property}_update", str(runtime))
+                vs.models["configuration_version"].store(
+                    device, self.property, result, str(runtime)
+                )
         except Exception:
             setattr(device, f"last_{self.property}_status", "Failure")
             setattr(device, f"last_{self.property}_failure", str(runtime))
@@ -1,8 +1,12 @@
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from copy import deepcopy
 from heapq import heappop, heappush
+from operator import attrgetter
 from sqlalchemy import Boolean, ForeignKey, Integer
 from sqlalchemy.orm import backref, relationship
 from sqlalchemy.schema import UniqueConstraint
+from traceback import format_exc
 from wtforms.validators import NumberRange
 
 from eNMS.database import db
@@ -31,6 +35,8 @@ class Workflow(Service):
     man_minutes_type = db.Column(db.TinyString, default="workflow")
     man_minutes = db.Column(Integer, default=0)
     man_minutes_total = db.Column(Integer, default=0)
+    parallel_branches = db.Column(Boolean, default=False)
+    max_concurrent_services = db.Column(Integer, default=5)
     services = relationship(
         "Service",
         secondary=db.service_workflow_table,
@@ -126,72 +132,127 @@ class Workflow(Service):
 
     @property
     def deep_services(self):
-        services = [
-            service.deep_services if service.type == "workflow" else [service]
-            for service in self.services
-        ]
-        return [self] + sum(services, [])
+        services = [self]
+        for service in self.services:
+            if service.type == "workflow":
+                services.extend(service.deep_services)
+            else:
+                services.append(service)
+        return services
 
     @property
     def deep_edges(self):
-        edges = [
-            workflow.edges
-            for workflow in set(self.deep_services)
-            if workflow.type == "workflow"
-        ]
-        return sum(edges, [])
+        edges = []
+        for workflow in set(self.deep_services):
+            if workflow.type == "workflow":
+                edges.extend(workflow.edges)
+        return edges
+
+    def get_graph(self):
+        key = (
+            self.last_modified,
+            tuple((service.id, service.last_modified) for service in self.services),
+            tuple(edge.id for edge in self.edges),
+        )
+        if self.id in vs.workflow_graphs and vs.workflow_graphs[self.id][0] == key:
+            return vs.workflow_graphs[self.id][1]
+        successors = defaultdict(lambda: defaultdict(list))
+        children, descendants = defaultdict(set), {}
+        for edge in sorted(self.edges, key=attrgetter("id")):
+            successors[edge.subtype][edge.source_id].append(
+                (edge.id, edge.destination_id)
+            )
+            children[edge.source_id].add(edge.destination_id)
+        for service_id in list(children):
+            visited, stack = set(), [service_id]
+            while stack:
+                for child in children[stack.pop()] - visited:
+                    visited.add(child)
+                    stack.append(child)
+            descendants[service_id] = visited
+        predecessors = defaultdict(set)
+        for source_id, destinations in children.items():
+            for destination_id in destinations:
+                if source_id not in descendants.get(destination_id, ()):
+                    predecessors[destination_id].add(source_id)
+        graph = {
+            "children": {
+                service_id: frozenset(destinations)
+                for service_id, destinations in children.items()
+            },
+            "descendants": descendants,
+            "end": db.fetch("service", scoped_name="End", rbac=None).id,
+            "predecessors": {
+                service_id: frozenset(sources)
+                for service_id, sources in predecessors.items()
+            },
+            "priority": {service.id: 1 / service.priority for service in self.services},
+            "skipped": frozenset(
+                service.id
+                for service in self.services
+                if service.skip.get(self.name, False)
+            ),
+            "start": db.fetch("service", scoped_name="Start", rbac=None).id,
+            "successors": {
+                subtype: {
+                    service_id: tuple(edges)
+                    for service_id, edges in subtype_successors.items()
+                }
+                for subtype, subtype_successors in successors.items()
+            },
+        }
+        vs.workflow_graphs[self.id] = (key, graph)
+        return graph
 
     def job(self, run, device=None):
-        number_of_runs = defaultdict(int)
-        start = db.fetch("service", scoped_name="Start", rbac=None)
-        end = db.fetch("service", scoped_name="End", rbac=None)
-        services, targets = [], defaultdict(set)
+        graph, number_of_runs = self.get_graph(), defaultdict(int)
+        service_store = {service.id: service for service in self.services}
+        services, targets, running = [], defaultdict(set), {}
         start_targets = [device] if device else run.target_devices
-        for service_id in run.start_services or [start.id]:
-            service = db.fetch("service", id=service_id, rbac=None)
-            targets[service.name] |= {device.name for device in start_targets}
-            heappush(services, (1 / service.priority, service))
+        start_services = [int(id) for id in run.start_services or [graph["start"]]]
+        for service_id in start_services:
+            if service_id not in service_store:
+                service = db.fetch("service", id=service_id, rbac=None)
+                service_store[service_id] = service
+            targets[service_id] |= {device.name for device in start_targets}
+            heappush(services, (1 / service_store[service_id].priority, service_id))
         visited, restart_run = set(), run.restart_run
         tracking_bfs = run.run_method == "per_service_with_workflow_targets"
         device_store = {device.name: device for device in start_targets}
-        while services:
-            if run.stop:
-                return {"success": False, "result": "Aborted"}
-            _, service = heappop(services)
-            if number_of_runs[service.name] >= service.maximum_runs:
-                continue
-            number_of_runs[service.name] += 1
-            visited.add(service)
-            if service in (start, end) or service.skip.get(self.name, False):
-                success = service.skip_value == "success"
-                results = {"result": "skipped", "success": success}
-                if tracking_bfs or device:
-                    results["summary"] = {
-                        "success": targets[service.name],
-                        "failure": [],
-                    }
+        executor, max_workers = None, self.max_concurrent_services
+        pending, triggered, branch_payloads = {}, set(), {}
+        if self.parallel_branches:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            reachable = set(start_services).union(
+                *(graph["descendants"].get(id, ()) for id in start_services)
+            )
+            for service_id, sources in graph["predecessors"].items():
+                pending[service_id] = set(sources) & reachable
+
+        def schedule(service_id):
+            if pending.get(service_id):
+                triggered.add(service_id)
             else:
-                kwargs = {
-                    "service": run.placeholder
-                    if service.scoped_name == "Placeholder"
-                    else service,
-                    "workflow": self,
-                    "restart_run": restart_run,
-                    "parent": run,
-                    "parent_runtime": run.parent_runtime,
-                    "workflow_run_method": run.run_method,
-                }
-                if tracking_bfs or device:
-                    kwargs["target_devices"] = []
-                    for name in targets[service.name]:
-                        if name not in device_store:
-                            device_store[name] = db.fetch("device", name=name)
-                        kwargs["target_devices"].append(device_store[name])
-                if run.parent_device:
-                    kwargs["parent_device"] = run.parent_device
-                results = Runner(run, payload=run.payload, **kwargs).results
-                if not results:
-                    continue
+                triggered.discard(service_id)
+                heappush(services, (graph["priority"][service_id], service_id))
+
+        def release(service_id):
+            released = [service_id]
+            while released:
+                source_id = released.pop()
+                for child_id in graph["children"].get(source_id, ()):
+                    sources = pending.get(child_id)
+                    if not sources or source_id not in sources:
+                        continue
+                    sources.discard(source_id)
+                    if sources:
+                        continue
+                    elif child_id in triggered:
+                        schedule(child_id)
+                    else:
+                        released.append(child_id)
+
+        def complete(service_id, results):
             status = "success" if results["success"] else "failure"
             summary = results.get("summary", {})
             if not tracking_bfs and not device:
@@ -201,23 +262,113 @@ class Workflow(Service):
                     continue
                 if (tracking_bfs or device) and not summary[edge_type]:
                     continue
-                for edge in service.neighbors(self, edge_type):
-                    successor = edge.destination
+                edge_successors = graph["successors"].get(edge_type, {})
+                for edge_id, successor_id in edge_successors.get(service_id, ()):
                     if tracking_bfs or device:
-                        targets[successor.name] |= set(summary[edge_type])
-                    heappush(services, ((1 / successor.priority, successor)))
+                        targets[successor_id] |= set(summary[edge_type])
+                    schedule(successor_id)
                     if tracking_bfs or device:
                         run.write_state(
-                            f"edges/{edge.id}", len(summary[edge_type]), "increment"
+                            f"edges/{edge_id}", len(summary[edge_type]), "increment"
                         )
                     else:
-                        run.write_state(f"edges/{edge.id}", "DONE")
+                        run.write_state(f"edges/{edge_id}", "DONE")
+            if executor:
+                release(service_id)
+
+        try:
+            while services or running or triggered:
+                if run.stop:
+                    return {"success": False, "result": "Aborted"}
+                if not services and not running:
+                    for service_id in list(triggered):
+                        pending[service_id].clear()
+                        schedule(service_id)
+                    continue
+                if not services or executor and len(running) >= max_workers:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        service_id = running.pop(future)
+                        self.merge_payload(run.payload, *branch_payloads.pop(future))
+                        try:
+                            results = future.result()
+                        except Exception:
+                            run.log("error", format_exc())
+                            results = {"success": False, "result": format_exc()}
+                            if tracking_bfs or device:
+                                results["summary"] = {
+                                    "success": [],
+                                    "failure": list(targets[service_id]),
+                                }
+                        if results:
+                            complete(service_id, results)
+                        elif executor:
+                            release(service_id)
+                    continue
+                _, service_id = heappop(services)
+                service = service_store[service_id]
+                if number_of_runs[service_id] >= service.maximum_runs:
+                    continue
+                number_of_runs[service_id] += 1
+                visited.add(service_id)
+                if (
+                    service_id in (graph["start"], graph["end"])
+                    or service_id in graph["skipped"]
+                ):
+                    success = service.skip_value == "success"
+                    results = {"result": "skipped", "success": success}
+                    if tracking_bfs or device:
+                        results["summary"] = {
+                            "success": targets[service_id],
+                            "failure": [],
+                        }
+                    complete(service_id, results)
+                    continue
+                if service.scoped_name == "Placeholder":
+                    service = run.placeholder
+                target_names = targets[service_id] if tracking_bfs or device else None
+                if executor:
+                    snapshot = deepcopy(run.payload)
+                    branch_payload = deepcopy(snapshot)
+                    future = executor.submit(
+                        self.run_branch_service,
+                        run,
+                        service.id,
+                        target_names,
+                        restart_run,
+                        branch_payload,
+                    )
+                    running[future] = service_id
+                    branch_payloads[future] = (snapshot, branch_payload)
+                    continue
+                kwargs = {
+                    "service": service,
+                    "workflow": self,
+                    "restart_run": restart_run,
+                    "parent": run,
+                    "parent_runtime": run.parent_runtime,
+                    "workflow_run_method": run.run_method,
+                }
+                if target_names is not None:
+                    kwargs["target_devices"] = []
+                    for name in target_names:
+                        if name not in device_store:
+                            device_store[name] = db.fetch("device", name=name)
+                        kwargs["target_devices"].append(device_store[name])
+                if run.parent_device:
+                    kwargs["parent_device"] = run.parent_device
+                results = Runner(run, payload=run.payload, **kwargs).results
+                if results:
+                    complete(service_id, results)
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
         if tracking_bfs or device:
-            failed = list(targets[start.name] - targets[end.name])
-            summary = {"success": list(targets[end.name]), "failure": failed}
+            failed = list(targets[graph["start"]] - targets[graph["end"]])
+            summary = {"success": list(targets[graph["end"]]), "failure": failed}
             results = {"success": not failed, "summary": summary}
         else:
-            results = {"success": end in visited}
+            results = {"success": graph["end"] in visited}
         run.restart_run = restart_run
         if run.is_main_run and self.man_minutes:
             self.man_minutes_total += (
@@ -227,6 +378,50 @@ class Workflow(Service):
             )
         return results
 
+    @classmethod
+    def merge_payload(cls, payload, snapshot, branch_payload):
+        for key in snapshot.keys() - branch_payload.keys():
+            payload.pop(key, None)
+        for key, value in branch_payload.items():
+            if key in snapshot and snapshot[key] == value:
+                continue
+            elif all(
+                isinstance(dictionary.get(key), dict)
+                for dictionary in (payload, snapshot, branch_payload)
+            ):
+                cls.merge_payload(payload[key], snapshot[key], value)
+            else:
+                payload[key] = value
+
+    def run_branch_service(self, run, service_id, target_names, restart_run, payload):
+        try:
+            kwargs = {
+                "service": db.fetch("service", id=service_id, rbac=None),
+                "workflow": db.fetch("workflow", id=self.id, rbac=None),
+                "restart_run": restart_run,
+                "parent": run,
+                "parent_runtime": run.parent_runtime,
+                "workflow_run_method": run.run_method,
+            }
+            if target_names is not None:
+                kwargs["target_devices"] = (
+                    db.query("device", rbac=None)
+                    .filter(vs.models["device"].name.in_(target_names))
+                    .all()
+                )
+            if run.parent_device:
+                kwargs["parent_device"] = db.fetch(
+                    "device", id=run.parent_device.id, rbac=None
+                )
+            results = Runner(run, payload=payload, **kwargs).results
+            db.session.commit()
+            return results
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
 
 class WorkflowForm(ServiceForm):
     form_type = HiddenField(default="workflow")
@@ -260,6 +455,12 @@ class WorkflowForm(ServiceForm):
     man_minutes_total = IntegerField(
         "Total Number of Minutes", default=0, render_kw={"readonly": True}
     )
+    parallel_branches = BooleanField("Run Independent Branches in Parallel")
+    max_concurrent_services = IntegerField(
+        "Maximum Number of Services Running Concurrently",
+        [NumberRange(min=1)],
+        default=5,
+    )
     superworkflow = InstanceField(
         "Superworkflow",
         constraints={"children": ["[Shared] Placeholder"], "children_filter": "union"},
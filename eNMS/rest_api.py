@@ -1,4 +1,5 @@
 from collections import defaultdict
+from dramatiq import group
 from flask_login import current_user
 from threading import Thread
 from traceback import format_exc
@@ -24,6 +25,7 @@ class RestApi:
             "instance": "update_instance",
             "migrate": "migrate",
             "run_service": "run_service",
+            "run_services": "run_services",
             "run_task": "run_task",
             "search": "search",
             "topology": "topology",
@@ -36,6 +38,8 @@ class RestApi:
     allowed_endpoints = [
         "get_cluster_status",
         "get_git_content",
+        "get_result_metrics",
+        "get_run_registry",
         "update_all_pools",
         "update_database_configurations_from_git",
         "update_device_rbac",
@@ -57,7 +61,7 @@ class RestApi:
             relation_names_only=True, exclude=["positions"]
         )
 
-    def get_result(self, name, runtime, **_):
+    def get_result(self, name, runtime, devices="false", **_):
         run = db.fetch("run", service_name=name, runtime=runtime, allow_none=True)
         if not run:
             error_message = (
@@ -67,10 +71,16 @@ class RestApi:
             return {"error": error_message}
         else:
             result = db.fetch("result", runtime=runtime, allow_none=True)
-            return {
+            response = {
                 "status": run.status,
                 "result": result.result if result else "No results yet.",
             }
+            if devices.lower() == "true":
+                response["devices"] = {
+                    device_name: device_result
+                    for *_, device_name, device_result in db.get_device_results(runtime)
+                }
+            return response
 
     def get_workers(self):
         return env.get_workers()
@@ -87,50 +97,95 @@ class RestApi:
         results = db.fetch(instance_type, allow_none=True, all_matches=True, **kwargs)
         return [result.get_properties(exclude=["positions"]) for result in results]
 
-    def run_service(self, **kwargs):
-        if "rest_api" not in vs.server_data["allowed_automation"]:
-            return {"error": "Runs from the REST API are not allowed on this server."}
-        data = {"trigger": "REST API", "creator": current_user.name, **kwargs}
-        errors, devices, pools = [], [], []
-        service = db.fetch("service", name=data.pop("name"), rbac="run")
+    def get_run_targets(self, runs):
+        targets = {}
+        for key, model, property in (
+            ("devices", "device", "name"),
+            ("ip_addresses", "device", "ip_address"),
+            ("pools", "pool", "name"),
+        ):
+            values = {value for run in runs for value in run.get(key, "")}
+            targets[key] = dict(
+                db.fetch_many(model, property, values, properties=[property, "id"])
+            )
+        return targets
+
+    def prepare_run(self, service, data, targets, runtimes=()):
         if service.disabled:
             return {"error": "The workflow is disabled."}
         service.check_restriction_to_owners("run")
-        run_name = kwargs.get("form", {}).get("name")
+        run_name = data.get("form", {}).get("name")
         if run_name and db.fetch("run", name=run_name, allow_none=True, rbac=None):
             return {"error": "There is already a run with the same name."}
-        handle_asynchronously = data.get("async", True)
-        for device_name in data.get("devices", ""):
-            device = db.fetch("device", name=device_name, allow_none=True)
-            if device:
-                devices.append(device.id)
-            else:
-                errors.append(f"No device with the name '{device_name}'")
-        for device_ip in data.get("ip_addresses", ""):
-            device = db.fetch("device", ip_address=device_ip, allow_none=True)
-            if device:
-                devices.append(device.id)
-            else:
-                errors.append(f"No device with the IP address '{device_ip}'")
-        for pool_name in data.get("pools", ""):
-            pool = db.fetch("pool", name=pool_name, allow_none=True)
-            if pool:
-                pools.append(pool.id)
-            else:
-                errors.append(f"No pool with the name '{pool_name}'")
-        if errors and not kwargs.get("ignore_invalid_targets"):
+        errors, devices, pools = [], [], []
+        for key, model, label, ids in (
+            ("devices", "device", "name", devices),
+            ("ip_addresses", "device", "IP address", devices),
+            ("pools", "pool", "name", pools),
+        ):
+            for value in data.get(key, ""):
+                if value in targets[key]:
+                    ids.append(targets[key][value])
+                else:
+                    errors.append(f"No {model} with the {label} '{value}'")
+        if errors and not data.get("ignore_invalid_targets"):
             return {"errors": errors}
         if devices or pools:
             data.update({"target_devices": devices, "target_pools": pools})
-        data["runtime"] = runtime = vs.get_time()
-        if handle_asynchronously:
+        runtime = vs.get_time()
+        while runtime in runtimes:
+            runtime = vs.get_time()
+        data["runtime"] = runtime
+        return {"errors": errors, "runtime": runtime}
+
+    def run_service(self, **kwargs):
+        if "rest_api" not in vs.server_data["allowed_automation"]:
+            return {"error": "Runs from the REST API are not allowed on this server."}
+        data = {"trigger": "REST API", "creator": current_user.name, **kwargs}
+        service = db.fetch("service", name=data.pop("name"), rbac="run")
+        response = self.prepare_run(service, data, self.get_run_targets([data]))
+        if "runtime" not in response:
+            return response
+        if data.get("async", True):
             if vs.settings["automation"]["use_task_queue"]:
                 controller.run.send(service.id, **data)
             else:
                 Thread(target=controller.run, args=(service.id,), kwargs=data).start()
-            return {"errors": errors, "runtime": runtime}
+            return response
+        else:
+            return {**controller.run(service.id, **data), "errors": response["errors"]}
+
+    def run_services(self, list_data=(), **kwargs):
+        if "rest_api" not in vs.server_data["allowed_automation"]:
+            return {"error": "Runs from the REST API are not allowed on this server."}
+        data = {"trigger": "REST API", "creator": current_user.name}
+        runs = [{**data, **run} for run in kwargs.get("runs", list_data)]
+        names = {run.get("name") for run in runs}
+        services = {
+            service.name: service
+            for service in db.fetch_many("service", "name", names, rbac="run")
+        }
+        targets, responses, jobs, runtimes = self.get_run_targets(runs), [], [], set()
+        for data in runs:
+            name = data.pop("name", None)
+            if name not in services:
+                error = f"No service with the name '{name}'"
+                responses.append({"name": name, "error": error})
+                continue
+            try:
+                response = self.prepare_run(services[name], data, targets, runtimes)
+            except db.rbac_error as exc:
+                response = {"error": str(exc)}
+            if "runtime" in response:
+                runtimes.add(response["runtime"])
+                jobs.append((services[name].id, data))
+            responses.append({"name": name, **response})
+        if vs.settings["automation"]["use_task_queue"]:
+            group(controller.run.message(id, **data) for id, data in jobs).run()
         else:
-            return {**controller.run(service.id, **data), "errors": errors}
+            for service_id, data in jobs:
+                Thread(target=controller.run, args=(service_id,), kwargs=data).start()
+        return responses
 
     def run_task(self, task_id):
         if "scheduler" not in vs.server_data["allowed_automation"]:
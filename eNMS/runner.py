@@ -1,9 +1,14 @@
+from ast import comprehension, Lambda, Name, NamedExpr, parse as parse_ast, walk
+from asyncio import gather, get_running_loop, run as run_event_loop, Semaphore
 from builtins import __dict__ as builtins
+from collections import defaultdict
 from copy import deepcopy
 from datetime import datetime
-from functools import partial
+from functools import lru_cache, partial
+from hashlib import sha256
 from importlib import __import__ as importlib_import
 from io import BytesIO, StringIO
+from itertools import chain
 from jinja2 import Template
 from json import dump, load, loads
 from json.decoder import JSONDecodeError
@@ -18,9 +23,9 @@ from re import compile, search
 from requests import post
 from scp import SCPClient
 from sys import getsizeof
-from threading import Thread
-from time import sleep
-from traceback import format_exc
+from threading import Lock, Thread
+from time import monotonic, perf_counter, sleep
+from traceback import format_exc, format_exception
 from types import GeneratorType
 from warnings import warn
 from xmltodict import parse
@@ -43,6 +48,9 @@ from eNMS.variables import vs
 
 
 class Runner:
+    skip_builtins = ("all", "any", "bool", "float", "int", "len", "max", "min", "str")
+    substitution_regex = compile("{{(.*?)}}")
+
     def __init__(self, run, **kwargs):
         self.parameterized_run = False
         self.is_main_run = kwargs.pop("is_main_run", False)
@@ -56,6 +64,11 @@ class Runner:
         self.parent_runtime = kwargs.get("parent_runtime")
         self.runtime = self.parent_runtime if self.is_main_run else vs.get_time()
         self.has_result = False
+        if self.is_main_run:
+            self.result_buffer, self.result_buffer_lock = [], Lock()
+            self.state_buffer, self.state_buffer_lock = defaultdict(int), Lock()
+            self.last_result_flush = self.last_state_flush = monotonic()
+            self.credential_map, self.credential_secrets = {}, {}
         vs.run_instances[self.runtime] = self
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -70,6 +83,8 @@ class Runner:
         creator = db.fetch("user", name=self.main_run.creator, rbac=None)
         self.is_admin_run = creator.is_admin
         self.creator_dict = {"name": creator.name, "email": creator.email}
+        self.base_variables = self.get_base_variables()
+        self.eval_count, self.eval_time, self.eval_lock = 0, 0, Lock()
         if not self.is_main_run:
             self.path = f"{run.path}>{self.service.id}"
         db.session.commit()
@@ -79,6 +94,10 @@ class Runner:
     def __repr__(self):
         return f"{self.runtime}: SERVICE '{self.service}'"
 
+    @property
+    def main_runner(self):
+        return vs.run_instances[self.parent_runtime]
+
     def __getattr__(self, key):
         if key in self.__dict__:
             return self.__dict__[key]
@@ -132,6 +151,7 @@ class Runner:
 
     @property
     def progress(self):
+        self.main_runner.flush_state()
         progress = self.main_run.get_state().get(self.path, {}).get("progress")
         try:
             progress = progress["device"]
@@ -143,18 +163,15 @@ class Runner:
 
     def compute_devices_from_query(_self, query, property, **locals):  # noqa: N805
         values = _self.eval(query, **locals)[0]
-        devices, not_found = set(), []
         if isinstance(values, str):
             values = [values]
-        for value in values:
-            if isinstance(value, vs.models["device"]):
-                device = value
-            else:
-                device = db.fetch("device", allow_none=True, **{property: value})
-            if device:
-                devices.add(device)
-            else:
-                not_found.append(value)
+        devices, device_class = set(), vs.models["device"]
+        devices.update(value for value in values if isinstance(value, device_class))
+        values = [value for value in values if not isinstance(value, device_class)]
+        matches = db.fetch_many("device", property, values)
+        devices.update(matches)
+        found = {str(getattr(device, property)) for device in matches}
+        not_found = [str(value) for value in values if str(value) not in found]
         if not_found:
             raise Exception(f"Device query invalid targets: {', '.join(not_found)}")
         return devices
@@ -175,10 +192,17 @@ class Runner:
                 pool.compute_pool()
             devices |= set(pool.devices)
         db.session.commit()
+        allowed_devices = db.fetch_many(
+            "device",
+            "id",
+            [device.id for device in devices],
+            properties=["id"],
+            rbac="target",
+            username=self.creator,
+        )
+        allowed_ids = {device_id for device_id, in allowed_devices}
         restricted_devices = set(
-            device
-            for device in devices
-            if device.id not in vs.run_targets[self.parent_runtime]
+            device for device in devices if device.id not in allowed_ids
         )
         if restricted_devices:
             result = (
@@ -203,11 +227,18 @@ class Runner:
         if env.redis_queue:
             if isinstance(value, bool):
                 value = str(value)
-            env.redis(
-                {None: "set", "append": "lpush", "increment": "incr"}[method],
-                f"{self.parent_runtime}/state/{self.path}/{path}",
-                value,
-            )
+            key, field = f"{self.parent_runtime}/state", f"{self.path}/{path}"
+            if method == "increment":
+                self.main_runner.buffer_state(field, value)
+            elif method == "append":
+                env.redis_pipeline(
+                    [
+                        ("rpush", f"{key}/{field}", value),
+                        ("sadd", f"{key}/lists", field),
+                    ]
+                )
+            else:
+                env.redis("hset", key, field, value)
         else:
             *keys, last = f"{self.parent_runtime}/{self.path}/{path}".split("/")
             store = vs.run_states
@@ -221,6 +252,26 @@ class Runner:
             else:
                 store.setdefault(last, []).append(value)
 
+    def buffer_state(self, field, value):
+        interval = vs.settings["redis"]["state_flush_interval"]
+        with self.state_buffer_lock:
+            self.state_buffer[field] += value
+            flush = monotonic() - self.last_state_flush >= interval
+        if flush:
+            self.flush_state()
+
+    def flush_state(self):
+        if not env.redis_queue:
+            return
+        with self.state_buffer_lock:
+            increments, self.state_buffer = self.state_buffer, defaultdict(int)
+            self.last_state_flush = monotonic()
+        if increments:
+            key = f"{self.parent_runtime}/state"
+            env.redis_pipeline(
+                ("hincrby", key, field, value) for field, value in increments.items()
+            )
+
     def start_run(self):
         self.init_state()
         self.write_state("status", "Running")
@@ -235,6 +286,8 @@ class Runner:
             self.log("error", result)
             results.update({"success": False, "result": result})
         finally:
+            self.main_runner.flush_results()
+            self.main_runner.flush_state()
             try:
                 db.session.commit()
             except Exception:
@@ -242,9 +295,10 @@ class Runner:
                 error = "\n".join(format_exc().splitlines())
                 self.log("error", error)
                 results.update({"success": False, "error": error})
-            if self.update_pools_after_running:
-                for pool in db.fetch_all("pool", username=self.creator, rbac="edit"):
-                    pool.compute_pool()
+            incremental_update = vs.settings["pools"]["incremental_update"]
+            if self.update_pools_after_running and not incremental_update:
+                pools = db.fetch_all("pool", username=self.creator, rbac="edit")
+                vs.models["pool"].compute_pools(pools)
             report = self.generate_report(results) if self.service.report else ""
             if self.get("send_notification"):
                 try:
@@ -259,12 +313,16 @@ class Runner:
             now = datetime.now().replace(microsecond=0)
             results["duration"] = str(now - start)
             self.write_state("result/success", results["success"])
+            if self.eval_count:
+                self.write_state("expressions/count", self.eval_count)
+                self.write_state("expressions/time", round(self.eval_time, 6))
             if self.is_main_run:
                 state = self.main_run.get_state()
                 status = "Aborted" if self.stop else "Completed"
-                self.main_run.state = state
+                state["status"] = status
+                self.main_run.store_state(state)
                 self.main_run.duration = results["duration"]
-                self.main_run.status = state["status"] = status
+                self.main_run.status = status
                 self.success = results["success"]
                 self.close_remaining_connections()
             if self.main_run.task and not (
@@ -277,8 +335,10 @@ class Runner:
             if self.is_main_run or len(self.target_devices) > 1 or must_have_results:
                 results = self.create_result(results, run_result=self.is_main_run)
             if env.redis_queue and self.is_main_run:
-                runtime_keys = env.redis("keys", f"{self.parent_runtime}/*") or []
-                env.redis("delete", *runtime_keys)
+                runtime_keys = env.redis("scan_iter", f"{self.parent_runtime}/*")
+                runtime_keys = list(runtime_keys or [])
+                if runtime_keys:
+                    env.redis("delete", *runtime_keys)
             vs.custom.run_post_processing(self, results)
 
         self.results = results
@@ -311,6 +371,50 @@ class Runner:
         run = vs.run_instances[runtime]
         results.append(run.get_results(device))
 
+    def get_async_device_result(self, device_id, queued_time):
+        queueing_time = monotonic() - queued_time
+        try:
+            device = db.fetch("device", id=device_id)
+            self.log("info", f"Queued for {queueing_time:.3f}s", device)
+            results = self.get_results(device)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+        return results, queueing_time
+
+    async def async_device_run(self, devices, processes):
+        loop, semaphore = get_running_loop(), Semaphore(processes)
+
+        async def device_job(device_id, queued_time):
+            async with semaphore:
+                return await loop.run_in_executor(
+                    env.device_executor,
+                    self.get_async_device_result,
+                    device_id,
+                    queued_time,
+                )
+
+        jobs = (device_job(device.id, monotonic()) for device in devices)
+        outputs = await gather(*jobs, return_exceptions=True)
+        results = []
+        for device, output in zip(devices, outputs):
+            if not isinstance(output, BaseException):
+                results.append(output)
+                continue
+            traceback = format_exception(type(output), output, output.__traceback__)
+            error = "".join(traceback).rstrip()
+            self.log("error", f"Device job failed:\n{error}", device)
+            failed_result = {
+                "device_target": device.name,
+                "success": False,
+                "result": error,
+            }
+            results.append((failed_result, 0))
+        return results
+
     def device_iteration(self, device):
         derived_devices = self.compute_devices_from_query(
             self.service.iteration_devices,
@@ -353,6 +457,7 @@ class Runner:
             f"{self.progress_key}/total", len(self.target_devices), "increment"
         )
         non_skipped_targets, skipped_targets, results = [], [], []
+        queueing_time = None
         skip_service = self.skip.get(getattr(self.workflow, "name", None))
         if skip_service:
             self.write_state("status", "Skipped")
@@ -367,29 +472,22 @@ class Runner:
                 "result": "skipped",
                 "runtime": self.runtime,
             }
+        skipped_devices = self.get_skipped_devices(skip_service)
+        if skipped_devices:
+            skipped = len(skipped_devices)
+            self.write_state(f"{self.progress_key}/skipped", skipped, "increment")
         for device in self.target_devices:
-            skip_device = skip_service
-            if not skip_service and self.skip_query:
-                skip_device = self.eval(self.skip_query, **locals())[0]
-            if skip_device:
-                if device:
-                    self.write_state(f"{self.progress_key}/skipped", 1, "increment")
-                if self.skip_value == "discard":
-                    continue
-                device_results = {
-                    "device_target": getattr(device, "name", None),
-                    "runtime": vs.get_time(),
-                    "result": "skipped",
-                    "duration": "0:00:00",
-                    "success": self.skip_value == "success",
-                }
-                skipped_targets.append(device.name)
-                self.create_result(device_results, device, commit=False)
-                results.append(device_results)
-            else:
+            if device not in skipped_devices:
                 non_skipped_targets.append(device)
+            elif self.skip_value != "discard":
+                skipped_targets.append(device)
+        if skipped_targets:
+            results.extend(self.create_skipped_results(skipped_targets))
+            skipped_targets = [device.name for device in skipped_targets]
         all_skipped = self.target_devices and not non_skipped_targets
         self.target_devices = non_skipped_targets
+        if getattr(self.service, "credentials", "object") != "object":
+            self.prefetch_credentials(self.target_devices)
         if self.run_method != "per_device":
             if all_skipped:
                 return {"success": self.skip_value == "success", "summary": summary}
@@ -422,13 +520,26 @@ class Runner:
                 and not self.iteration_run
             ):
                 processes = min(len(non_skipped_targets), self.get("max_processes"))
-                process_args = [
-                    (device.id, self.runtime, results) for device in non_skipped_targets
-                ]
-                self.log("info", f"Starting a pool of {processes} threads")
                 self.in_process = True
-                with ThreadPool(processes=processes) as pool:
-                    pool.map(self.get_device_result, process_args)
+                if self.get("multiprocessing_mode") == "asyncio":
+                    self.log("info", f"Starting an event loop with {processes} tasks")
+                    async_results = run_event_loop(
+                        self.async_device_run(non_skipped_targets, processes)
+                    )
+                    queueing_times = [time for _, time in async_results]
+                    results.extend(result for result, _ in async_results)
+                    queueing_time = {
+                        "average": round(sum(queueing_times) / len(queueing_times), 3),
+                        "maximum": round(max(queueing_times), 3),
+                    }
+                else:
+                    process_args = [
+                        (device.id, self.runtime, results)
+                        for device in non_skipped_targets
+                    ]
+                    self.log("info", f"Starting a pool of {processes} threads")
+                    with ThreadPool(processes=processes) as pool:
+                        pool.map(self.get_device_result, process_args)
                 self.in_process = False
             else:
                 results.extend(
@@ -440,16 +551,94 @@ class Runner:
             for result in results:
                 key = "success" if result["success"] else "failure"
                 summary[key].append(result["device_target"])
-            return {
+            device_run_results = {
                 "summary": summary,
                 "success": all(result["success"] for result in results if result),
                 "runtime": self.runtime,
             }
+            if queueing_time:
+                device_run_results["queueing_time"] = queueing_time
+            return device_run_results
+
+    def get_skipped_devices(self, skip_service):
+        if skip_service:
+            return set(self.target_devices)
+        elif not self.skip_query or not self.target_devices:
+            return set()
+        names = self.get_expression_names(self.skip_query)
+        payload_variables = self.payload.get("variables", {})
+        payload_names = {
+            *self.payload.get("form", {}),
+            *payload_variables,
+            *chain.from_iterable(payload_variables.get("devices", {}).values()),
+        }
+        if (
+            names is None
+            or names - {"device", *self.skip_builtins}
+            or names & payload_names
+        ):
+            skipped_devices = set()
+            for device in self.target_devices:
+                if self.eval(self.skip_query, **locals())[0]:
+                    skipped_devices.add(device)
+            return skipped_devices
+        start, code = perf_counter(), self.compile_expression(self.skip_query, "eval")
+        skip_builtins = names.intersection(self.skip_builtins)
+        variables = {"__builtins__": {name: builtins[name] for name in skip_builtins}}
+        skipped_devices = set()
+        for device in self.target_devices:
+            variables["device"] = device
+            if builtins["eval"](code, variables):
+                skipped_devices.add(device)
+        with self.eval_lock:
+            self.eval_count += len(self.target_devices)
+            self.eval_time += perf_counter() - start
+        return skipped_devices
+
+    @staticmethod
+    @lru_cache(maxsize=vs.settings["automation"]["expression_cache_size"])
+    def get_expression_names(query):
+        try:
+            tree = parse_ast(query, mode="eval")
+        except SyntaxError:
+            return
+        names = set()
+        for node in walk(tree):
+            if isinstance(node, (comprehension, Lambda, NamedExpr)):
+                return
+            elif isinstance(node, Name):
+                names.add(node.id)
+        return frozenset(names)
+
+    def create_skipped_results(self, devices):
+        success = self.skip_value == "success"
+        results = [
+            {
+                "device_target": device.name,
+                "runtime": vs.get_time(),
+                "result": "skipped",
+                "duration": "0:00:00",
+                "success": success,
+            }
+            for device in devices
+        ]
+        self.success = success
+        if self.disable_result_creation and success:
+            return results
+        self.has_result = True
+        self.main_runner.buffer_results(
+            (result, self.get_result_kw(device))
+            for result, device in zip(results, devices)
+        )
+        return results
 
     def check_size_before_commit(self, data, data_type):
         column_type = "pickletype" if data_type == "result" else "large_string"
         data_size = getsizeof(str(data))
-        max_allowed_size = vs.database["columns"]["length"][column_type]
+        if vs.settings["blob_store"]["active"]:
+            max_allowed_size = vs.settings["blob_store"]["max_size"]
+        else:
+            max_allowed_size = vs.database["columns"]["length"][column_type]
         if data_size >= max_allowed_size:
             logs = (
                 f"The {data_type} is too large to be committed to the database\n"
@@ -465,21 +654,7 @@ class Runner:
 
     def create_result(self, results, device=None, commit=True, run_result=False):
         self.success = results["success"]
-        result_kw = {
-            "parent_runtime": self.parent_runtime,
-            "parent_service_id": self.main_run.service.id,
-            "path": self.path,
-            "run_id": self.main_run.id,
-            "service_id": self.service.id,
-            "labels": self.main_run.labels,
-            "creator": self.main_run.creator,
-        }
-        if self.workflow:
-            result_kw["workflow_id"] = self.workflow.id
-        if self.parent_device:
-            result_kw["parent_device_id"] = self.parent_device.id
-        if device:
-            result_kw["device_id"] = device.id
+        result_kw = self.get_result_kw(device)
         if self.is_main_run and not device:
             self.payload = self.make_json_compliant(self.payload)
             results["payload"] = self.payload
@@ -496,11 +671,12 @@ class Runner:
                     rbac=None,
                 )
             if self.main_run.trigger == "REST API":
-                results["devices"] = {}
-                for result in self.main_run.results:
-                    if not result.device:
-                        continue
-                    results["devices"][result.device.name] = result.result
+                results["devices"] = {
+                    device_name: result
+                    for *_, device_name, result in db.get_device_results(
+                        self.parent_runtime
+                    )
+                }
         else:
             results.pop("payload", None)
         create_failed_results = self.disable_result_creation and not self.success
@@ -509,14 +685,98 @@ class Runner:
         if not self.disable_result_creation or create_failed_results or run_result:
             self.has_result = True
             try:
-                db.factory(
-                    "result", result=results, commit=commit, rbac=None, **result_kw
-                )
+                if device and not run_result:
+                    self.main_runner.buffer_result(results, **result_kw)
+                    if commit:
+                        db.session.commit()
+                else:
+                    if vs.settings["automation"]["result_metrics"]:
+                        vs.models["result_metric"].store([{**results, **result_kw}])
+                    db.factory(
+                        "result", result=results, commit=commit, rbac=None, **result_kw
+                    )
             except Exception:
                 self.log("critical", f"Failed to commit result:\n{format_exc()}")
                 db.session.rollback()
         return results
 
+    def get_result_kw(self, device=None):
+        result_kw = {
+            "parent_runtime": self.parent_runtime,
+            "parent_service_id": self.main_run.service.id,
+            "path": self.path,
+            "run_id": self.main_run.id,
+            "service_id": self.service.id,
+            "labels": self.main_run.labels,
+            "creator": self.main_run.creator,
+        }
+        if self.workflow:
+            result_kw["workflow_id"] = self.workflow.id
+        if self.parent_device:
+            result_kw["parent_device_id"] = self.parent_device.id
+        if device:
+            result_kw["device_id"] = device.id
+        return result_kw
+
+    def buffer_result(self, results, **result_kw):
+        self.buffer_results([(results, result_kw)])
+
+    def buffer_results(self, results):
+        settings = vs.settings["automation"]["result_buffer"]
+        defaults = vs.models["result"].get_row_defaults()
+        rows = [
+            {
+                **defaults,
+                "result": result,
+                **{key: result[key] for key in ("duration", "runtime", "success")},
+                **result_kw,
+            }
+            for result, result_kw in results
+        ]
+        with self.result_buffer_lock:
+            self.result_buffer.extend(rows)
+            flush = (
+                len(self.result_buffer) >= settings["size"]
+                or monotonic() - self.last_result_flush >= settings["flush_interval"]
+            )
+        if flush:
+            self.flush_results()
+
+    def flush_results(self):
+        with self.result_buffer_lock:
+            rows, self.result_buffer = self.result_buffer, []
+            self.last_result_flush = monotonic()
+        if not rows:
+            return
+        start, failed_rows = monotonic(), 0
+        try:
+            self.insert_results(rows)
+        except Exception:
+            self.log("error", f"Bulk insert of results failed:\n{format_exc()}")
+            for row in rows:
+                try:
+                    self.insert_results([row])
+                except Exception:
+                    failed_rows += 1
+                    self.log("critical", f"Failed to insert result:\n{format_exc()}")
+        try:
+            db.session.commit()
+        except Exception:
+            self.log("critical", f"Failed to commit results:\n{format_exc()}")
+            db.session.rollback()
+            failed_rows = len(rows)
+        flush_time = int((monotonic() - start) * 1000)
+        self.write_state("result_buffer/flushes", 1, "increment")
+        self.write_state("result_buffer/rows", len(rows) - failed_rows, "increment")
+        self.write_state("result_buffer/failed_rows", failed_rows, "increment")
+        self.write_state("result_buffer/time", flush_time, "increment")
+
+    def insert_results(self, rows):
+        with db.session.begin_nested():
+            db.session.execute(vs.models["result"].__table__.insert(), rows)
+            if vs.settings["automation"]["result_metrics"]:
+                vs.models["result_metric"].store(rows)
+
     def run_service_job(self, device):
         args = (device,) if device else ()
         retries, total_retries = self.number_of_retries + 1, 0
@@ -663,6 +923,7 @@ class Runner:
             and (log_level == -1 or severity not in vs.log_levels[log_level:])
         ):
             return
+        device_name = None
         if device:
             device_name = device if isinstance(device, str) else device.name
             log = f"DEVICE {device_name} - {log}"
@@ -678,9 +939,16 @@ class Runner:
                 f"{vs.get_time()} - {severity} - USER {self.creator} -"
                 f" SERVICE {self.service.scoped_name} - {log}"
             )
-            env.log_queue(self.parent_runtime, self.service.id, run_log)
+            env.log_queue(
+                self.parent_runtime, self.service.id, run_log, device=device_name
+            )
             if not self.is_main_run:
-                env.log_queue(self.parent_runtime, self.main_run.service.id, run_log)
+                env.log_queue(
+                    self.parent_runtime,
+                    self.main_run.service.id,
+                    run_log,
+                    device=device_name,
+                )
 
     def build_notification(self, results):
         notification = {
@@ -709,6 +977,7 @@ class Runner:
                 variables = {
                     "service": self.service,
                     "results": results,
+                    "get_device_results": self.get_device_results,
                     **self.global_variables(),
                 }
                 if self.service.report_jinja2_template:
@@ -729,22 +998,27 @@ class Runner:
             )
         return report
 
+    def get_device_results(self):
+        return {
+            device_name: result
+            for *_, device_name, result in db.get_device_results(
+                self.parent_runtime, self.service.id
+            )
+        }
+
     def notify(self, results, report):
         self.log("info", f"Sending {self.send_notification_method} notification...")
         notification = self.build_notification(results)
         file_content = deepcopy(notification)
         if self.include_device_results:
-            file_content["Device Results"] = {}
-            for device in self.target_devices:
-                device_result = db.fetch(
-                    "result",
-                    service_id=self.service.id,
-                    parent_runtime=self.parent_runtime,
-                    device_id=device.id,
-                    allow_none=True,
+            device_ids = {device.id for device in self.target_devices}
+            file_content["Device Results"] = {
+                device_name: result
+                for _, device_id, device_name, result in db.get_device_results(
+                    self.parent_runtime, self.service.id
                 )
-                if device_result:
-                    file_content["Device Results"][device.name] = device_result.result
+                if device_id in device_ids
+            }
         if self.send_notification_method == "mail":
             filename = self.runtime.replace(".", "").replace(":", "")
             status = "PASS" if results["success"] else "FAILED"
@@ -779,26 +1053,27 @@ class Runner:
     def get_credentials(self, device, add_secret=True):
         result, credential_type = {}, self.main_run.service.credential_type
         if self.credentials == "object":
-            credential = self.named_credential
+            name, secrets = self.get_credential_secrets(self.named_credential)
+        elif device:
+            name, secrets = self.get_device_credential(device)
         else:
             credential = db.get_credential(
                 self.creator,
-                device=device,
                 credential_type=credential_type,
                 optional=self.credentials != "device",
             )
-        if credential:
+            name, secrets = self.get_credential_secrets(credential)
+        if name:
             device_log = f" for '{device.name}'" if device else ""
-            self.log("info", f"Using '{credential.name}' credential{device_log}")
-        if add_secret and device and credential:
-            result["secret"] = env.get_password(credential.enable_password)
+            self.log("info", f"Using '{name}' credential{device_log}")
+        if add_secret and device and name:
+            result["secret"] = secrets["secret"]
         if self.credentials in ("device", "object"):
-            result["username"] = credential.username
-            if credential.subtype == "password":
-                result["password"] = env.get_password(credential.password)
+            result["username"] = secrets["username"]
+            if "password" in secrets:
+                result["password"] = secrets["password"]
             else:
-                private_key = env.get_password(credential.private_key)
-                result["pkey"] = RSAKey.from_private_key(StringIO(private_key))
+                result["pkey"] = secrets["pkey"]
         else:
             result["username"] = self.sub(self.custom_username, locals())
             password = env.get_password(self.custom_password)
@@ -928,7 +1203,7 @@ class Runner:
         def recursive_search(run):
             if not run:
                 return None
-            query = db.session.query(vs.models["result"]).filter(
+            query = db.session.query(vs.models["result"].result).filter(
                 vs.models["result"].parent_runtime == run.runtime
             )
             if workflow:
@@ -946,9 +1221,9 @@ class Runner:
                 return recursive_search(run.restart_run)
             else:
                 if all_matches:
-                    return [result.result for result in results]
+                    return [result for result, in results]
                 else:
-                    return results.pop().result
+                    return results.pop()[0]
 
         return recursive_search(self.main_run)
 
@@ -972,14 +1247,70 @@ class Runner:
 
     def get_credential(self, **kwargs):
         credential = db.get_credential(self.creator, **kwargs)
-        credential_dict = {"username": credential.username}
-        if credential.subtype == "password":
-            credential_dict["password"] = env.get_password(credential.password)
-        else:
-            private_key = env.get_password(credential.private_key)
-            credential_dict["pkey"] = RSAKey.from_private_key(StringIO(private_key))
-        credential_dict["secret"] = env.get_password(credential.enable_password)
-        return credential_dict
+        return dict(self.get_credential_secrets(credential)[1])
+
+    def get_credential_secrets(self, credential):
+        if not credential:
+            return None, {}
+        secrets = self.main_runner.credential_secrets
+        if credential.id not in secrets:
+            credential_dict = {"username": credential.username}
+            if credential.subtype == "password":
+                credential_dict["password"] = env.get_password(credential.password)
+            else:
+                private_key = env.get_password(credential.private_key)
+                credential_dict["pkey"] = RSAKey.from_private_key(StringIO(private_key))
+            credential_dict["secret"] = env.get_password(credential.enable_password)
+            secrets[credential.id] = (credential.name, credential_dict)
+        return secrets[credential.id]
+
+    def get_device_credential(self, device):
+        credential_map = self.main_runner.credential_map
+        if device.id not in credential_map:
+            self.prefetch_credentials([device])
+        credential_id = credential_map[device.id]
+        if not credential_id:
+            if self.credentials == "device":
+                error = f"No matching credentials found for DEVICE '{device.name}'"
+                raise Exception(error)
+            return None, {}
+        elif credential_id not in self.main_runner.credential_secrets:
+            credential = db.fetch("credential", rbac=None, id=credential_id)
+            return self.get_credential_secrets(credential)
+        return self.main_runner.credential_secrets[credential_id]
+
+    def prefetch_credentials(self, devices):
+        credential_map = self.main_runner.credential_map
+        devices = [device for device in devices if device.id not in credential_map]
+        if devices:
+            credential_map.update(
+                db.get_device_credentials(
+                    self.creator,
+                    devices,
+                    role=self.main_run.service.credential_type,
+                )
+            )
+
+    def get_base_variables(self):
+        variables = {
+            "delete": partial(self.database_function, "delete"),
+            "dict_to_string": vs.dict_to_string,
+            "encrypt": env.encrypt_password,
+            "factory": partial(self.database_function, "factory"),
+            "fetch": partial(self.database_function, "fetch"),
+            "fetch_all": partial(self.database_function, "fetch_all"),
+            "get_all_results": self.get_all_results,
+            "get_connection": self.get_connection,
+            "get_result": self.get_result,
+            "get_var": self.get_var,
+            "log": self.log,
+            "prepend_filepath": self.prepend_filepath,
+            "send_email": env.send_email,
+            "set_var": self.payload_helper,
+        }
+        if self.is_admin_run:
+            variables["get_credential"] = self.get_credential
+        return variables
 
     def global_variables(_self, **locals):  # noqa: N805
         payload, device = _self.payload, locals.get("device")
@@ -987,55 +1318,53 @@ class Runner:
         variables.update(payload.get("variables", {}))
         if device and "devices" in payload.get("variables", {}):
             variables.update(payload["variables"]["devices"].get(device.name, {}))
+        variables.update(_self.base_variables)
         variables.update(
             {
                 "__builtins__": {**builtins, "__import__": _self._import},
-                "delete": partial(_self.database_function, "delete"),
                 "devices": _self.target_devices,
-                "dict_to_string": vs.dict_to_string,
-                "encrypt": env.encrypt_password,
-                "factory": partial(_self.database_function, "factory"),
-                "fetch": partial(_self.database_function, "fetch"),
-                "fetch_all": partial(_self.database_function, "fetch_all"),
-                "get_all_results": _self.get_all_results,
-                "get_connection": _self.get_connection,
-                "get_result": _self.get_result,
-                "get_var": _self.get_var,
-                "log": _self.log,
                 "parent_device": _self.parent_device or device,
                 "payload": _self.payload,
                 "placeholder": _self.main_run.placeholder,
-                "prepend_filepath": _self.prepend_filepath,
-                "send_email": env.send_email,
                 "server": {
                     "ip_address": vs.server_ip,
                     "name": vs.server,
                     "url": vs.server_url,
                 },
-                "set_var": _self.payload_helper,
-                "user": _self.creator_dict,
+                "user": dict(_self.creator_dict),
                 "workflow": _self.workflow,
             }
         )
-        if _self.is_admin_run:
-            variables["get_credential"] = _self.get_credential
         return variables
 
+    @staticmethod
+    @lru_cache(maxsize=vs.settings["automation"]["expression_cache_size"])
+    def compile_expression(query, function):
+        return builtins["compile"](query, "<string>", function)
+
     def eval(_self, query, function="eval", **locals):  # noqa: N805
         exec_variables = _self.global_variables(**locals)
-        results = builtins[function](query, exec_variables) if query else ""
+        if not query:
+            return "", exec_variables
+        start = perf_counter()
+        try:
+            code = _self.compile_expression(query, function)
+            results = builtins[function](code, exec_variables)
+        finally:
+            with _self.eval_lock:
+                _self.eval_count += 1
+                _self.eval_time += perf_counter() - start
         return results, exec_variables
 
     def sub(self, input, variables):
-        regex = compile("{{(.*?)}}")
         variables["payload"] = self.payload
 
         def replace(match):
-            return str(self.eval(match.group()[2:-2], **variables)[0])
+            return str(self.eval(match.group(1), **variables)[0])
 
         def rec(input):
             if isinstance(input, str):
-                return regex.sub(replace, input)
+                return self.substitution_regex.sub(replace, input)
             elif isinstance(input, list):
                 return [rec(item) for item in input]
             elif isinstance(input, dict):
@@ -1078,7 +1407,7 @@ class Runner:
         return connection
 
     def netmiko_connection(self, device):
-        connection = self.get_or_close_connection("netmiko", device.name)
+        connection = self.get_or_close_connection("netmiko", device)
         connection_name = f"Netmiko Connection '{self.connection_name}'"
         if connection:
             self.log("info", f"Using cached {connection_name}", device)
@@ -1133,13 +1462,11 @@ class Runner:
                 kwargs["config_command"] = self.config_mode_command
             netmiko_connection.config_mode(**kwargs)
         netmiko_connection.password = "*" * 8
-        vs.connections_cache["netmiko"][self.parent_runtime].setdefault(
-            device.name, {}
-        )[self.connection_name] = netmiko_connection
+        self.cache_connection("netmiko", device, netmiko_connection)
         return netmiko_connection
 
     def scrapli_connection(self, device):
-        connection = self.get_or_close_connection("scrapli", device.name)
+        connection = self.get_or_close_connection("scrapli", device)
         connection_name = f"Scrapli Connection '{self.connection_name}'"
         if connection:
             self.log("info", f"Using cached {connection_name}", device)
@@ -1175,13 +1502,11 @@ class Runner:
             **kwargs,
         )
         connection.open()
-        vs.connections_cache["scrapli"][self.parent_runtime].setdefault(
-            device.name, {}
-        )[self.connection_name] = connection
+        self.cache_connection("scrapli", device, connection)
         return connection
 
     def napalm_connection(self, device):
-        connection = self.get_or_close_connection("napalm", device.name)
+        connection = self.get_or_close_connection("napalm", device)
         connection_name = f"NAPALM Connection '{self.connection_name}'"
         if connection:
             self.log("info", f"Using cached {connection_name}", device)
@@ -1209,13 +1534,11 @@ class Runner:
             **credentials,
         )
         napalm_connection.open()
-        vs.connections_cache["napalm"][self.parent_runtime].setdefault(device.name, {})[
-            self.connection_name
-        ] = napalm_connection
+        self.cache_connection("napalm", device, napalm_connection)
         return napalm_connection
 
     def ncclient_connection(self, device):
-        connection = self.get_or_close_connection("ncclient", device.name)
+        connection = self.get_or_close_connection("ncclient", device)
         connection_name = f"NCClient Connection '{self.connection_name}'"
         if connection:
             self.log("info", f"Using cached {connection_name}", device)
@@ -1237,36 +1560,91 @@ class Runner:
             username=credentials["username"],
             password=credentials["password"],
         )
-        vs.connections_cache["ncclient"][self.parent_runtime].setdefault(
-            device.name, {}
-        )[self.connection_name] = ncclient_connection
+        self.cache_connection("ncclient", device, ncclient_connection)
         return ncclient_connection
 
+    def cache_connection(self, library, device, connection):
+        cache = vs.connections_cache[library][self.parent_runtime]
+        cache.setdefault(device.name, {})[self.connection_name] = connection
+        key = self.get_connection_key(library, device)
+        if key:
+            vs.connection_pool_keys[id(connection)] = key
+
+    def get_connection_key(self, library, device):
+        if (
+            not vs.settings["connection_pool"]["active"]
+            or self.credentials not in ("device", "object")
+            or getattr(self, "jump_on_connect", False)
+        ):
+            return
+        if library == "ncclient":
+            driver = device.netconf_driver
+        elif self.service.type == "scrapli_netconf_service":
+            driver = "netconf"
+        elif self.driver == "device":
+            driver = getattr(device, f"{library}_driver")
+        else:
+            driver = self.driver
+        if self.credentials == "object":
+            credential_id = self.named_credential.id
+            _, secrets = self.get_credential_secrets(self.named_credential)
+        else:
+            if device.id not in self.main_runner.credential_map:
+                self.prefetch_credentials([device])
+            credential_id = self.main_runner.credential_map[device.id]
+            if not credential_id:
+                return
+            _, secrets = self.get_device_credential(device)
+        secret = secrets.get("password") or secrets["pkey"].get_base64()
+        fingerprint = sha256(f"{secrets['username']}:{secret}".encode("utf-8"))
+        return (
+            library,
+            device.name,
+            device.ip_address,
+            device.port,
+            driver,
+            self.creator,
+            credential_id,
+            fingerprint.hexdigest(),
+        )
+
+    def get_pooled_connection(self, library, device):
+        key = self.get_connection_key(library, device)
+        if not key or self.start_new_connection:
+            return
+        connection = env.checkout_device_connection(key)
+        if connection:
+            self.cache_connection(library, device, connection)
+        return connection
+
     def get_or_close_connection(self, library, device):
-        connection = self.get_connection(library, device)
+        connection = self.get_connection(library, device.name)
         if not connection:
-            return
-        if self.start_new_connection:
-            return self.disconnect(library, device, connection)
-        if library == "napalm":
-            if connection.is_alive():
-                return connection
-            else:
-                self.disconnect(library, device, connection)
-        elif library == "ncclient":
-            if connection.connected:
-                return connection
+            connection = self.get_pooled_connection(library, device)
+            if not connection:
+                return
+        elif self.start_new_connection:
+            return self.disconnect(library, device.name, connection)
+        if self.is_connection_alive(library, connection):
+            return connection
+        self.disconnect(library, device.name, connection)
+
+    def is_connection_alive(self, library, connection):
+        try:
+            if library == "napalm":
+                is_alive = connection.is_alive()
+                return is_alive.get("is_alive", True)
+            elif library == "ncclient":
+                return connection.connected
+            elif library == "netmiko":
+                connection.find_prompt()
             else:
-                self.disconnect(library, device, connection)
-        else:
-            try:
-                if library == "netmiko":
-                    connection.find_prompt()
-                else:
-                    connection.get_prompt()
-                return connection
-            except Exception:
-                self.disconnect(library, device, connection)
+                connection.get_prompt()
+            return True
+        except NotImplementedError:
+            return True
+        except Exception:
+            return False
 
     def get_connection(self, library, device, name=None):
         cache = vs.connections_cache[library].get(self.parent_runtime, {})
@@ -1277,7 +1655,7 @@ class Runner:
         for library in ("netmiko", "napalm", "scrapli", "ncclient"):
             connection = self.get_connection(library, device)
             if connection:
-                self.disconnect(library, device, connection)
+                self.release_connection(library, device, connection)
 
     def close_remaining_connections(self):
         threads = []
@@ -1286,7 +1664,7 @@ class Runner:
             for device, connections in list(device_connections.items()):
                 for connection in list(connections.values()):
                     args = (library, device, connection)
-                    thread = Thread(target=self.disconnect, args=args)
+                    thread = Thread(target=self.release_connection, args=args)
                     thread.start()
                     threads.append(thread)
         for thread in threads:
@@ -1297,6 +1675,7 @@ class Runner:
     def disconnect(self, library, device, connection):
         connection_name = getattr(self, "connection_name", "default")
         connection_log = f"{library} connection '{connection_name}'"
+        vs.connection_pool_keys.pop(id(connection), None)
         try:
             if library == "netmiko":
                 connection.disconnect()
@@ -1311,9 +1690,22 @@ class Runner:
         except Exception as exc:
             self.log("error", f"Error while closing {connection_log} ({exc})", device)
 
+    def release_connection(self, library, device, connection):
+        key = vs.connection_pool_keys.pop(id(connection), None)
+        if not key or getattr(self, "close_connection", False):
+            return self.disconnect(library, device, connection)
+        connection_name = getattr(self, "connection_name", "default")
+        vs.connections_cache[library][self.parent_runtime][device].pop(
+            connection_name, None
+        )
+        env.checkin_device_connection(key, connection)
+        connection_log = f"{library} connection '{connection_name}'"
+        self.log("info", f"Released {connection_log} to the connection pool", device)
+
     def enter_remote_device(self, connection, device):
         if not getattr(self, "jump_on_connect", False):
             return
+        vs.connection_pool_keys.pop(id(connection), None)
         connection.find_prompt()
         prompt = connection.base_prompt
         password = self.sub(env.get_password(self.jump_password), locals())
@@ -8,7 +8,9 @@ from flask import (
     render_template,
     render_template_string,
     request,
+    Response,
     send_file,
+    stream_with_context,
     url_for,
     session,
 )
@@ -144,7 +146,7 @@ class Server(Flask):
                     username = credInfos[0]
                     password = credInfos[1]
                     authN = {'username':username, 'password':password}
-                    user = env.authenticate_user(**authN)
+                    user = env.authenticate_rest_user(**authN)
                 if user:
                     login_user(user)
             username = getattr(current_user, "name", "Unknown")
@@ -354,6 +356,12 @@ class Server(Flask):
             filename = f"/{controller.export_service(id)}.tgz"
             return send_file(filename, as_attachment=True)
 
+        @blueprint.route("/export_table/<model>", methods=["POST"])
+        @self.process_requests
+        def export_table(model):
+            stream = controller.export_table(model, **request.json)
+            return Response(stream_with_context(stream), mimetype="text/csv")
+
         @blueprint.route("/terminal/<session>")
         @self.process_requests
         def ssh_connection(session):
@@ -142,7 +142,6 @@ export class Table {
         contentType: "application/json",
         data: (data) => {
           Object.assign(data, {
-            export: self.csvExport,
             clipboard: self.copyClipboard,
             pagination: self.displayPagination,
             ...this.getFilteringData(),
@@ -155,10 +154,6 @@ export class Table {
             notify(result.error, "error", 5);
             return [];
           }
-          if (self.csvExport) {
-            self.exportTable(result.full_result);
-            self.csvExport = false;
-          }
           if (self.copyClipboard) {
             copyToClipboard({ text: result.full_result, includeText: false });
             self.copyClipboard = false;
@@ -179,7 +174,7 @@ export class Table {
     return [0, "asc"];
   }
 
-  exportTable(result) {
+  exportTable() {
     const visibleColumns = this.columns
       .filter((column) => {
         const isExportable = typeof column.export === "undefined" || column.export;
@@ -187,17 +182,18 @@ export class Table {
         return isExportable && visibleColumn;
       })
       .map((column) => column.name);
-    result = result.map((instance) => {
-      Object.keys(instance).forEach((key) => {
-        if (!visibleColumns.includes(key)) delete instance[key];
-      });
-      return visibleColumns.map((column) => `"${instance[column]}"`);
+    $.ajax({
+      type: "POST",
+      url: `/export_table/${this.model}`,
+      contentType: "application/json",
+      dataType: "text",
+      data: JSON.stringify({
+        ...this.getFilteringData(),
+        ...this.filteringData,
+        export_columns: visibleColumns,
+      }),
+      success: (content) => downloadFile(this.type, content, "csv"),
     });
-    downloadFile(
-      this.type,
-      [visibleColumns, ...result].map((e) => e.join(",")).join("\n"),
-      "csv"
-    );
   }
 
   getFilteringData() {
@@ -1220,6 +1216,33 @@ tables.device_result = class DeviceResultTable extends tables.result {
   }
 };
 
+tables.result_metric = class ResultMetricTable extends Table {
+  addRow({ properties, tableId }) {
+    const status = properties.success;
+    let row = super.addRow({ properties: properties, tableId: tableId });
+    row.success = `
+      <button
+        type="button"
+        class="btn btn-${status ? "success" : "danger"} btn-sm"
+        style="width:100%">${status ? "Success" : "Failure"}
+      </button>`;
+    return row;
+  }
+
+  get controls() {
+    return [
+      this.columnDisplay(),
+      this.refreshTableButton(),
+      this.clearSearchButton(),
+      this.exportTableButton(),
+    ];
+  }
+
+  get tableOrdering() {
+    return [0, "desc"];
+  }
+};
+
 tables.task = class TaskTable extends Table {
   addRow(kwargs) {
     let row = super.addRow(kwargs);
@@ -1803,9 +1826,7 @@ function copySelectionToClipboard(tableId) {
 }
 
 function exportTable(tableId) {
-  let table = tableInstances[tableId];
-  table.csvExport = true;
-  refreshTable(tableId);
+  tableInstances[tableId].exportTable();
 }
 
 export const refreshTable = function(tableId, notification, updateParent, firstPage) {
@@ -1,7 +1,7 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
 from git import Repo
-from json import load
+from json import dumps, load
 from logging import error
 from napalm._SUPPORTED_DRIVERS import SUPPORTED_DRIVERS
 from ncclient.devices import supported_devices_cfg
@@ -10,6 +10,8 @@ from os import getenv
 from pathlib import Path
 from string import punctuation
 from sys import modules
+from threading import Event, Lock
+from time import monotonic
 from traceback import format_exc
 from warnings import warn
 from wtforms.validators import __all__ as all_validators
@@ -25,6 +27,88 @@ except ImportError as exc:
     warn(f"Couldn't import scrapli module ({exc})")
 
 
+class RunRegistry:
+    def __init__(self, settings):
+        self.settings = settings
+        self.services = defaultdict(set)
+        self.states = defaultdict(dict)
+        self.logs = defaultdict(lambda: defaultdict(list))
+        self.device_logs = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+        self.stop = defaultdict(bool)
+        self.runs, self.lock, self.evicted = OrderedDict(), Lock(), 0
+
+    def complete(self, runtime):
+        with self.lock:
+            self.runs[runtime] = ("completed", monotonic())
+            self.runs.move_to_end(runtime)
+        self.evict()
+
+    def evict(self):
+        max_runs, now = self.settings["max_completed_runs"], monotonic()
+        with self.lock:
+            completed = [
+                (runtime, completion_time)
+                for runtime, (status, completion_time) in self.runs.items()
+                if status == "completed"
+            ]
+            evicted = {
+                runtime
+                for index, (runtime, completion_time) in enumerate(completed)
+                if index < len(completed) - max_runs
+                or now - completion_time > self.settings["completed_run_time"]
+            }
+            for runtime in evicted:
+                self.runs.pop(runtime)
+            for store in (
+                self.services,
+                self.states,
+                self.logs,
+                self.device_logs,
+                self.stop,
+            ):
+                for runtime in evicted | (set(store) - set(self.runs)):
+                    store.pop(runtime, None)
+            self.evicted += len(evicted)
+
+    def get_memory_usage(self):
+        self.evict()
+        runs, now = [], monotonic()
+        with self.lock:
+            registered_runs = list(self.runs.items())
+        for runtime, (status, timestamp) in registered_runs:
+            logs = [
+                line
+                for service_logs in list(self.logs.get(runtime, {}).values())
+                for line in service_logs or []
+            ]
+            try:
+                state_size = len(dumps(self.states.get(runtime, {}), default=str))
+            except RuntimeError:
+                state_size = None
+            runs.append(
+                {
+                    "runtime": runtime,
+                    "status": status,
+                    "age": round(now - timestamp, 1),
+                    "log_lines": len(logs),
+                    "log_size": sum(map(len, logs)),
+                    "state_size": state_size,
+                }
+            )
+        return {
+            "active": sum(run["status"] == "active" for run in runs),
+            "completed": sum(run["status"] == "completed" for run in runs),
+            "evicted": self.evicted,
+            "log_size": sum(run["log_size"] for run in runs),
+            "state_size": sum(run["state_size"] or 0 for run in runs),
+            "runs": runs,
+        }
+
+    def register(self, runtime):
+        with self.lock:
+            self.runs[runtime] = ("active", monotonic())
+
+
 class VariableStore:
     def __init__(self):
         self._set_setup_variables()
@@ -85,6 +169,17 @@ class VariableStore:
         self.log_levels = ["debug", "info", "warning", "error", "critical"]
         self.models = {}
         self.model_properties = defaultdict(lambda: {"type": "str"})
+        self.configuration_index = {}
+        self.credential_cache = {}
+        self.credential_version = 0
+        self.configuration_index_event = Event()
+        self.configuration_index_thread = None
+        self.configuration_index_time = {}
+        self.pool_matchers = {}
+        self.rbac_cache = {}
+        self.rbac_version = 0
+        self.table_cache = defaultdict(dict)
+        self.workflow_graphs = {}
         self.private_properties = self.database["private_properties"]
         self.private_properties_set = set(sum(self.private_properties.values(), []))
         self.property_names = {}
@@ -153,14 +248,16 @@ class VariableStore:
                 self.reports[path.name] = file.read()
 
     def _set_run_variables(self):
-        self.run_targets = {}
-        self.run_services = defaultdict(set)
-        self.run_states = defaultdict(dict)
-        self.run_logs = defaultdict(lambda: defaultdict(list))
-        self.run_stop = defaultdict(bool)
+        self.run_registry = RunRegistry(self.settings["run_registry"])
+        self.run_services = self.run_registry.services
+        self.run_states = self.run_registry.states
+        self.run_logs = self.run_registry.logs
+        self.run_device_logs = self.run_registry.device_logs
+        self.run_stop = self.run_registry.stop
         self.run_instances = {}
         libraries = ("netmiko", "napalm", "scrapli", "ncclient")
         self.connections_cache = {library: defaultdict(dict) for library in libraries}
+        self.connection_pool_keys = {}
         self.service_run_count = defaultdict(int)
 
     def set_template_context(self):
@@ -0,0 +1,59 @@
+from contextlib import contextmanager
+from flask_login import login_user
+from os import chdir, environ
+from pathlib import Path
+from pytest import fixture
+from tempfile import mkdtemp
+
+chdir(Path(__file__).resolve().parents[1])
+environ.setdefault("DATABASE_URL", f"sqlite:///{mkdtemp()}/database.db")
+
+from eNMS import db, server, vs
+
+
+@fixture
+def factory():
+    def create(model, **kwargs):
+        return db.factory(model, commit=True, rbac=None, **kwargs)
+
+    yield create
+    db.session.rollback()
+
+
+@fixture
+def restricted_user(factory):
+    return factory("user", name="restricted", password="restricted", is_admin=False)
+
+
+@fixture
+def login():
+    @contextmanager
+    def login(user):
+        with server.test_request_context():
+            login_user(user)
+            yield user
+
+    return login
+
+
+@fixture
+def main_runner():
+    def main_runner():
+        service = db.fetch("service", name="[Shared] Start", rbac=None)
+        runtime = vs.get_time()
+        run = db.factory(
+            "run",
+            commit=True,
+            rbac=None,
+            creator="admin",
+            path=str(service.id),
+            runtime=runtime,
+            service=service.id,
+            services=[service.id],
+            start_service=service.id,
+        )
+        run.properties, run.payload = {"runtime": runtime}, {}
+        run.run()
+        return run.service_run
+
+    return main_runner
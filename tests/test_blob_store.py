@@ -0,0 +1,20 @@
+from eNMS import db, vs
+
+
+def test_blob_rollback_leaves_collectable_orphan(monkeypatch, tmp_path):
+    settings = {"active": True, "orphan_retention": 0, "threshold": 0}
+    for setting, value in settings.items():
+        monkeypatch.setitem(vs.settings["blob_store"], setting, value)
+    monkeypatch.setattr(db.blob_store, "path", tmp_path)
+    db.factory("service_log", runtime="blob rollback", content="rolled back", rbac=None)
+    db.session.flush()
+    db.session.rollback()
+    assert not db.fetch("service_log", allow_none=True, runtime="blob rollback")
+    assert len(list(tmp_path.glob("*/*"))) == 1
+    log = db.factory(
+        "service_log", commit=True, rbac=None, runtime="blob commit", content="kept"
+    )
+    assert db.delete_orphan_blobs() == 1
+    assert len(list(tmp_path.glob("*/*"))) == 1
+    db.session.expire_all()
+    assert log.content == "kept"
@@ -0,0 +1,38 @@
+from eNMS import db, vs
+
+
+def test_rbac_cache_invalidation(factory, monkeypatch, restricted_user):
+    first = factory("device", name="rbac cache first", owners=[restricted_user.id])
+    ids = db.get_rbac_ids("device", "read", restricted_user)
+    assert first.id in ids
+    assert db.get_rbac_ids("device", "read", restricted_user) is ids
+    second = factory("device", name="rbac cache second", owners=[restricted_user.id])
+    ids = db.get_rbac_ids("device", "read", restricted_user)
+    assert {first.id, second.id} <= ids
+    monkeypatch.setattr(db, "get_shared_version", lambda name: "remote update")
+    assert db.get_rbac_ids("device", "read", restricted_user) is not ids
+
+
+def test_credential_cache_invalidation(factory, monkeypatch, restricted_user):
+    device = factory("device", name="credential cache device")
+    group = factory("group", name="credential cache group", users=[restricted_user.id])
+    pool = factory(
+        "pool", name="credential cache pool", manually_defined=True, devices=[device.id]
+    )
+    properties = {"groups": [group.id], "device_pools": [pool.id], "username": "admin"}
+    first = factory("credential", name="credential cache first", **properties)
+
+    def get_credential():
+        return db.get_device_credentials(restricted_user.name, [device])[device.id]
+
+    assert get_credential() == first.id
+    second = factory(
+        "credential", name="credential cache second", priority=2, **properties
+    )
+    assert get_credential() == second.id
+    table = vs.models["credential"].__table__
+    db.session.execute(table.update().where(table.c.id == first.id).values(priority=3))
+    db.session.commit()
+    assert get_credential() == second.id
+    monkeypatch.setattr(db, "get_shared_version", lambda name: "remote update")
+    assert get_credential() == first.id
@@ -0,0 +1,28 @@
+from eNMS import vs
+
+
+def test_signature_size_follows_document_size():
+    device, settings = vs.models["device"], vs.settings["configuration_index"]
+    small_size, _ = device.get_signature("hostname router")
+    assert small_size == 64
+    document = " ".join(f"interface Ethernet{index}" for index in range(2000))
+    size, signature = device.get_signature(document)
+    trigrams = len(device.get_trigrams(document))
+    assert size >= trigrams * settings["bits_per_trigram"]
+    assert size & (size - 1) == 0 and signature.bit_length() <= size
+
+
+def test_configuration_candidates(factory):
+    device = vs.models["device"]
+    matching = factory(
+        "device", name="index matching", configuration="ntp server 192.0.2.123"
+    )
+    other = factory("device", name="index other", configuration="hostname edge")
+    device.build_configuration_index("configuration")
+    candidates = device.get_configuration_candidates("configuration", "192.0.2.123")
+    assert matching.id in candidates and other.id not in candidates
+    added = factory(
+        "device", name="index added", configuration="ntp server 192.0.2.123"
+    )
+    candidates = device.get_configuration_candidates("configuration", "192.0.2.123")
+    assert added.id in candidates
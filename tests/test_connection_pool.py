@@ -0,0 +1,29 @@
+from eNMS import db, vs
+
+
+def test_connection_key_follows_credential(factory, main_runner, monkeypatch):
+    monkeypatch.setitem(vs.settings["connection_pool"], "active", True)
+    device = factory("device", name="pool key device", ip_address="192.0.2.10")
+    credential = factory(
+        "credential", name="pool key credential", username="admin", password="first"
+    )
+
+    def get_key(credential):
+        runner = main_runner()
+        runner.credentials, runner.named_credential = "object", credential
+        runner.driver, runner.jump_on_connect = "cisco_ios", False
+        return runner.get_connection_key("netmiko", device)
+
+    first_key = get_key(credential)
+    assert get_key(credential) == first_key
+    credential.update(password="second")
+    db.session.commit()
+    second_key = get_key(credential)
+    assert second_key != first_key
+    other_credential = factory(
+        "credential", name="pool key other", username="admin", password="second"
+    )
+    assert get_key(other_credential) not in (first_key, second_key)
+    device.update(ip_address="192.0.2.11")
+    db.session.commit()
+    assert get_key(credential) != second_key
@@ -0,0 +1,31 @@
+from eNMS import db, vs
+
+
+def test_heterogeneous_result_buffer_flush(factory, main_runner):
+    parent = factory("device", name="result buffer parent", ip_address="192.0.2.1")
+    child = factory("device", name="result buffer child", ip_address="192.0.2.2")
+    runner = main_runner()
+    result_kw = runner.get_result_kw()
+    results = {"duration": "0:00:00", "runtime": runner.runtime, "success": True}
+    runner.buffer_results(
+        [
+            ({**results, "result": "parent"}, {**result_kw, "device_id": parent.id}),
+            (
+                {**results, "success": False, "result": "child"},
+                {**result_kw, "device_id": child.id, "parent_device_id": parent.id},
+            ),
+        ]
+    )
+    runner.flush_results()
+    rows = {
+        result.device_id: result
+        for result in db.fetch_all(
+            "result", parent_runtime=runner.parent_runtime, rbac=None
+        )
+        if result.device_id in (parent.id, child.id)
+    }
+    assert rows[parent.id].parent_device_id is None
+    assert rows[parent.id].success and rows[parent.id].result["result"] == "parent"
+    assert rows[child.id].parent_device_id == parent.id
+    assert not rows[child.id].success and rows[child.id].result["result"] == "child"
+    assert vs.models["result"].get_row_defaults()["success"] is False
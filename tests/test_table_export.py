@@ -0,0 +1,20 @@
+from eNMS import controller
+
+
+def export_names(rbac="read"):
+    columns = [{"data": "name"}]
+    return controller.export_table("device", ["name"], rbac=rbac, columns=columns)
+
+
+def read_names(stream):
+    return set("".join(stream).splitlines()[1:])
+
+
+def test_export_table_applies_rbac(factory, login, restricted_user):
+    owned = factory("device", name="export owned", owners=[restricted_user.id])
+    hidden = factory("device", name="export hidden")
+    with login(restricted_user):
+        read_stream, edit_stream = export_names(), export_names("edit")
+    for names in (read_names(read_stream), read_names(edit_stream)):
+        assert owned.name in names and hidden.name not in names
+    assert {owned.name, hidden.name} <= read_names(export_names())
@@ -0,0 +1,18 @@
+from io import BytesIO
+from werkzeug.datastructures import FileStorage
+
+from eNMS import controller, db
+
+
+def test_topology_import_applies_rbac(factory, login, restricted_user):
+    owned = factory("device", name="import owned", owners=[restricted_user.id])
+    hidden = factory("device", name="import hidden", description="unchanged")
+    content = b"name,description\nimport owned,imported\nimport hidden,imported\n"
+    with login(restricted_user):
+        status = controller.topology_import(
+            FileStorage(BytesIO(content), filename="device.csv")
+        )
+    db.session.expire_all()
+    assert status == "Partial import (see logs)."
+    assert owned.description == "imported"
+    assert hidden.description == "unchanged"